@@ -3,14 +3,36 @@
 from __future__ import print_function
 
 import argparse
+import hashlib
 import json
 import os
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from os import path
 
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen
+
+try:
+    import yaml
+except ImportError:  # PyYAML is needed only to compute the deploy-stack plan
+    yaml = None
+
 
 def is_string(input):
     try:
@@ -44,6 +66,7 @@ class BaseCommand(object):
 
         parser.add_argument('remainder', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
 
+        self.parser = parser
         self.args = vars(parser.parse_args())
 
     @classmethod
@@ -70,12 +93,143 @@ class BaseCommand(object):
 class ManagerCommand(BaseCommand):
     """A command that runs on a cluster manager"""
     def pre_add_arguments(self, parser):
+        parser.add_argument('--metrics-file', help='Write OpenMetrics of the run to this file', default=os.environ.get('D_METRICS_FILE'))
+        parser.add_argument('--metrics-url', help='Push OpenMetrics of the run to this url', default=os.environ.get('D_METRICS_URL'))
         parser.add_argument('manager', help='Manager address')
 
     def __init__(self):
         super(ManagerCommand, self).__init__()
 
         self.host = Host(self.args.get('manager'))
+        self.metrics = Metrics(self.cmd_name(), hosts=[self.host])
+
+    def __call__(self):
+        try:
+            with self.metrics.measure('run'):
+                super(ManagerCommand, self).__call__()
+        finally:
+            self.export_metrics(self.args.get('metrics_file'), self.args.get('metrics_url'))
+
+    def export_metrics(self, metrics_file=None, metrics_url=None):
+        """Export metrics, never failing the command itself"""
+        try:
+            if metrics_file:
+                self.metrics.write(metrics_file)
+
+            if metrics_url:
+                self.metrics.push(metrics_url)
+
+        except (IOError, OSError) as e:
+            print('Failed to export metrics:', e)
+
+    def fetch_nodes(self):
+        """Fetch all swarm nodes and the running tasks with their resource reservations, as {node id: {tasks, cpus, memory}}, with a single query"""
+        output = [line for line in self.host.get_script_output(
+            'docker node inspect $(docker node ls -q); '
+            'echo ---; '
+            'docker inspect --type task $(docker service ps -q $(docker service ls -q) -f desired-state=running) '
+            "--format '{{.NodeID}}|{{json .Spec.Resources}}' 2>/dev/null; "  # fails when there are no services
+            'true',
+        ).split('\n') if len(line)]
+        separator = output.index('---')
+
+        tasks = dict()
+        for line in output[separator + 1:]:
+            node_id, resources = line.split('|', 1)
+            reservations = (json.loads(resources) or {}).get('Reservations') or {}
+
+            node = tasks.setdefault(node_id, dict(tasks=0, cpus=0, memory=0))
+            node['tasks'] += 1
+            node['cpus'] += reservations.get('NanoCPUs', 0)
+            node['memory'] += reservations.get('MemoryBytes', 0)
+
+        return json.loads(''.join(output[:separator])), tasks
+
+    @staticmethod
+    def job_script(args, node=None):
+        """Shell script running a container with given args on the manager.
+
+        When the node is set, the container runs as a one-off swarm service placed on that node,
+        so the node itself is never reached over ssh. The script follows the service output
+        and exits with the exit code of its container.
+        """
+        args = ' '.join(flatten_args(args))  # shell text, like the arguments of docker run over ssh
+        if node is None:
+            return 'docker run {args}'.format(args=args)
+
+        return '\n'.join([
+            'service=$(docker service create --detach --quiet --with-registry-auth --restart-condition none --constraint node.id=={node} {args}) || exit 1'.format(
+                node=quote(node['ID']),
+                args=args,
+            ),
+            'trap \'docker service rm "$service" >/dev/null\' EXIT',  # the service is removed when ssh is interrupted too
+            "trap 'exit 129' HUP INT TERM PIPE",
+            'docker service logs --follow --raw "$service" 2>/dev/null & logs=$!',
+            'while :; do',
+            '  task=$(docker service ps -q "$service" | head -n 1)',
+            "  state=$(docker inspect --format '{{.Status.State}}' \"$task\" 2>/dev/null)",
+            '  case "$state" in complete|failed|rejected|shutdown|orphaned) break;; esac',
+            '  sleep 1',
+            'done',
+            "code=$(docker inspect --format '{{.Status.ContainerStatus.ExitCode}}' \"$task\" 2>/dev/null)",
+            '[ "$state" = complete ] || [ "${code:-0}" != 0 ] || code=1',
+            'sleep 1; kill $logs 2>/dev/null',
+            'exit ${code:-1}',
+        ])
+
+
+class StackCommand(ManagerCommand):
+    """A command that deals with services of a running stack"""
+    def fetch_services(self, stack_name):
+        for service in self.host.get_output(
+            'docker', 'stack', 'services',
+            stack_name,
+            '--format', '"{{ .Name }}|{{ .Image }}"',
+        ):
+            yield service.split('|')
+
+    def get_services(self, name, image=None):
+        """Get services of the stack, optionally only the ones running given image"""
+        if image is not None:
+            image, _ = label_and_tag(image)  # only image name
+
+        for service, image_name in self.fetch_services(name):
+            service_image, _ = label_and_tag(image_name)
+
+            if image is None or service_image == image:
+                yield service
+
+    def fetch_all_services(self, label=None):
+        """Get (stack, service, image) of every service in the swarm, optionally filtered by label, with a single query"""
+        services = self.host.get_script_output(' '.join([
+            'docker service inspect $(docker service ls -q{filter})'.format(filter=' --filter label=' + quote(label) if label else ''),
+            """--format '{{ index .Spec.Labels "com.docker.stack.namespace" }}|{{ .Spec.Name }}|{{ .Spec.TaskTemplate.ContainerSpec.Image }}'""",
+            '2>/dev/null; true',  # docker service inspect fails when there are no services
+        ]))
+        return [service.split('|') for service in services.split('\n') if len(service)]
+
+    @staticmethod
+    def local_snapshot_path(name):
+        return path.join(os.environ.get('SNAPSHOT_DIR', '.d-snapshots'), '{name}.json'.format(name=name))
+
+    @staticmethod
+    def remote_snapshot_path(name):
+        return '{dir}/{name}/image-snapshot.json'.format(dir=os.environ.get('STACK_DIR', '/srv'), name=name)
+
+    @staticmethod
+    def run_id():
+        """Id of the CI run, every update-image within a single run adds to the same snapshot"""
+        return os.environ.get('D_RUN_ID', os.environ.get('CIRCLE_WORKFLOW_ID'))
+
+    def load_snapshot(self, name):
+        """Load the snapshot saved on the manager, or the local one if the manager has none"""
+        snapshot = self.host.get_script_output('cat {} 2>/dev/null; true'.format(quote(self.remote_snapshot_path(name))))
+        if len(snapshot.strip()):
+            return json.loads(snapshot)
+
+        if path.exists(self.local_snapshot_path(name)):
+            with open(self.local_snapshot_path(name)) as f:
+                return json.load(f)
 
 
 class ImageCommand(BaseCommand):
@@ -126,6 +280,36 @@ def run_with_output(*args):
     return subprocess.check_output(flatten_args(args)).decode()
 
 
+def popen(*args):
+    return subprocess.Popen(flatten_args(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def interpolate(value, env):
+    """Substitute $VAR, ${VAR}, ${VAR:-default}, ${VAR-default}, ${VAR:?error} and $$ in all strings of docker-compose config, like docker stack deploy does"""
+    if isinstance(value, dict):
+        return {key: interpolate(item, env) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [interpolate(item, env) for item in value]
+
+    if not is_string(value):
+        return value
+
+    def substitute(match):
+        escaped, name, operator, argument, plain_name = match.groups()
+        if escaped:
+            return '$'
+
+        name = name or plain_name
+        if operator in [':-', ':?'] and env.get(name, '') == '' or operator in ['-', '?'] and name not in env:
+            assert '?' not in operator, 'Variable {name} is required: {error}'.format(name=name, error=argument)
+            return argument
+
+        return env.get(name, '')
+
+    return re.sub(r'\$(?:(\$)|\{([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-?])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))', substitute, value)
+
+
 def label_and_tag(name):
     got = name.split(':')
     if len(got) == 1:
@@ -133,6 +317,178 @@ def label_and_tag(name):
     return got
 
 
+def with_tag(image):
+    """Strip the digest and add the implicit latest tag, so image references are comparable. Keeps registry ports, like registry:5000/org/img"""
+    image = (image or '').split('@')[0]
+    if ':' not in image.split('/')[-1]:
+        image = ':'.join([image, 'latest'])
+
+    return image
+
+
+class LineBuffer(object):
+    """Bounded buffer of lines between a producer and a consumer
+
+    When the buffer is full, the oldest lines are dropped, so the producer never waits
+    for a slow consumer. The consumer gets a notice about every dropped chunk.
+
+    Usage:
+        buffer = LineBuffer(size=1000)
+
+        buffer.put('line')  # in the producer thread
+        buffer.close()
+
+        for line in buffer:  # in the consumer thread
+            print(line)
+
+    """
+    def __init__(self, size):
+        self.lines = deque(maxlen=size)
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, line):
+        with self.condition:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+
+            self.lines.append(line)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while not len(self.lines) and not self.closed:
+                    self.condition.wait(1)  # with timeout, to stay interruptible with ^C
+
+                if not len(self.lines):
+                    return
+
+                line = self.lines.popleft()
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                yield '... {} lines dropped ...'.format(dropped)
+
+            yield line
+
+
+class Metrics(object):
+    """Metrics of a single command run in the OpenMetrics text format
+
+    Every metric is a gauge describing the last run, so the file can be consumed
+    by the node_exporter textfile collector or pushed to the Prometheus pushgateway.
+
+    Usage:
+        metrics = Metrics('update-image', hosts=[host])
+
+        with metrics.measure('service_update', service='mystack_backend'):
+            host.run('docker', 'service', 'update', ...)
+
+        metrics.write('/var/lib/node_exporter/d.prom')
+
+    """
+    def __init__(self, command, hosts=None):
+        self.command = command
+        self.hosts = hosts or []
+        self.measurements = list()  # (metric, labels, seconds, succeeded)
+
+    @contextmanager
+    def measure(self, metric, **labels):
+        started = time.time()
+        try:
+            yield
+        except BaseException:  # exit() raises SystemExit
+            self.record(metric, labels, time.time() - started, False)
+            raise
+
+        self.record(metric, labels, time.time() - started, True)
+
+    def record(self, metric, labels, seconds, succeeded):
+        self.measurements.append((metric, labels, seconds, succeeded))
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def sample(cls, name, labels, value):
+        labels = ','.join('{key}="{value}"'.format(key=key, value=cls.escape(value)) for key, value in sorted(labels.items()))
+
+        return '{name}{{{labels}}} {value}'.format(name=name, labels=labels, value=value)
+
+    def render(self, previous=''):
+        """Render metrics of the run, keeping samples of other commands from the previously rendered text"""
+        families = OrderedDict()  # every family is rendered as a single block, as OpenMetrics requires
+        own = re.compile(r'[{{,]command="{}"[,}}]'.format(re.escape(self.escape(self.command))))
+        for line in previous.split('\n'):
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                families.setdefault(line.split(' ')[2], dict(headers=[], samples=[]))['headers'].append(line)
+            elif len(line) and not line.startswith('#') and not own.search(line):
+                families.setdefault(re.split(r'[{ ]', line)[0], dict(headers=[], samples=[]))['samples'].append(line)
+
+        command = dict(command=self.command)
+
+        def gauge(name, help, samples):
+            if len(samples):
+                family = families.setdefault(name, dict(headers=[], samples=[]))
+                family['headers'] = ['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name)]
+                family['samples'].extend(self.sample(name, labels, value) for labels, value in samples)
+
+        for metric in sorted(set(measurement[0] for measurement in self.measurements)):
+            measurements = [m for m in self.measurements if m[0] == metric]
+            gauge('d_{}_duration_seconds'.format(metric), 'Duration of every {} in the last run'.format(metric.replace('_', ' ')), [
+                (dict(command, result='success' if succeeded else 'failure', **labels), '{:.3f}'.format(seconds))
+                for _, labels, seconds, succeeded in measurements
+            ])
+            gauge('d_{}s'.format(metric), 'Number of {}s in the last run'.format(metric.replace('_', ' ')), [
+                (dict(command, result=result), len([m for m in measurements if m[3] == (result == 'success')]))
+                for result in ['success', 'failure']
+            ])
+
+        hosts = [host for host in self.hosts if not host.is_local()]
+        gauge('d_ssh_round_trips', 'Number of ssh connections in the last run', [(dict(command, host=host.name), host.round_trips) for host in hosts])
+        gauge('d_ssh_sent_bytes', 'Bytes copied to the host in the last run', [(dict(command, host=host.name), host.bytes_sent) for host in hosts])
+        gauge('d_ssh_received_bytes', 'Bytes of command output received from the host in the last run', [
+            (dict(command, host=host.name), host.bytes_received) for host in hosts
+        ])
+        gauge('d_last_run_timestamp_seconds', 'Time of the last run', [(command, int(time.time()))])
+
+        lines = list()
+        for family in families.values():
+            if len(family['samples']):
+                lines.extend(family['headers'] + family['samples'])
+
+        return '\n'.join(lines + ['# EOF', ''])
+
+    def write(self, filename):
+        """Write metrics atomically, so the collector never reads a half-written file.
+
+        Metrics of other commands in the file are kept, so every command of a CI job could write to the same file.
+        """
+        previous = ''
+        if path.exists(filename):
+            with open(filename) as f:
+                previous = f.read()
+
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render(previous))
+
+        os.rename(tmp, filename)
+
+    def push(self, url):
+        """Push metrics to the pushgateway-compatible endpoint"""
+        request = Request(url, data=self.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4'})
+        urlopen(request, timeout=10).close()
+
+
 class Host(object):
     """Represents a remote host you can ssh to
 
@@ -152,20 +508,35 @@ class Host(object):
 
     def __init__(self, name):
         self.name = name
+        self.control_path = None  # set to share a single ssh connection between commands
+
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def ssh(self):
+        options = list()
+        if self.control_path is not None:
+            options = ['-o', 'ControlMaster=auto', '-o', 'ControlPath={}'.format(self.control_path), '-o', 'ControlPersist=60']
+
+        return ['ssh'] + options + [self.name]
 
     def add_prefix(self, remote, cmd):
         if self.is_local():
             return cmd
 
+        self.round_trips += 1
         return remote + list(cmd)
 
     def run(self, *args):
         """Run SSH command"""
-        return run(*self.add_prefix(remote=['ssh', self.name], cmd=args))
+        return run(*self.add_prefix(remote=self.ssh, cmd=args))
 
     def get_output(self, *args):
         """Run SSH command and get output as a list of strings"""
-        output = run_with_output(*self.add_prefix(remote=['ssh', self.name], cmd=args))
+        output = run_with_output(*self.add_prefix(remote=self.ssh, cmd=args))
+        self.bytes_received += len(output)
 
         return [line for line in output.split('\n') if len(line)]
 
@@ -176,11 +547,36 @@ class Host(object):
 
         return json.loads(output)
 
+    def shell(self, script):
+        if self.is_local():
+            return ['sh', '-c', script]
+
+        self.round_trips += 1
+        return self.ssh + ['sh', '-c', quote(script)]
+
+    def run_script(self, script):
+        """Run shell script on the host"""
+        return run(self.shell(script))
+
+    def get_script_output(self, script):
+        """Run shell script on the host and get its output as a string"""
+        output = run_with_output(self.shell(script))
+        self.bytes_received += len(output)
+
+        return output
+
+    def stream(self, script):
+        """Run shell script on the host without waiting for it, stdout and stderr are available in the returned process"""
+        return popen(self.shell(script))
+
     def cp(self, src, dst):
         """Copy local file to the host"""
         if self.is_local():
             return run('cp', src, dst)
 
+        self.round_trips += 1
+        self.bytes_sent += path.getsize(src) if path.isfile(src) else 0
+
         return run('scp', src, '{hostname}:{dst}'.format(hostname=self.name, dst=dst))
 
     def __str__(self):
@@ -188,9 +584,11 @@ class Host(object):
 
 
 class DeployStack(ManagerCommand):
-    """Deploy or update a stack, using docker stack deploy"""
+    """Deploy or update a stack, updating only the services that have changed"""
     def add_arguments(self, parser):
         parser.add_argument('-c', '--config', help='Stack description in docker-compose format', default='docker-compose.prod.yml')
+        parser.add_argument('--plan', help='Only print the changes, do not apply them', action='store_true')
+        parser.add_argument('--full', help='Redeploy the whole stack with docker stack deploy --prune', action='store_true')
 
         parser.add_argument('name', help='Stack name')
 
@@ -201,10 +599,170 @@ class DeployStack(ManagerCommand):
     def stack_config_path(self, path='docker-compose.prod.yml'):
         return '{dir}/{path}'.format(dir=self.stack_path(), path=path)
 
-    def handle(self, config, name, remainder, **kwargs):
+    @staticmethod
+    def render_config(config, env):
+        """Read docker-compose file, interpolating variables from the manager environment, like docker stack deploy on the manager does"""
+        with open(config) as f:
+            return interpolate(yaml.safe_load(f) or {}, env)
+
+    def upload_config(self, config):
+        """Copy the config to the manager as is, docker stack deploy interpolates it there"""
         self.host.run('mkdir', '-p', self.stack_path())
         self.host.cp(config, self.stack_config_path())
 
+    def save_deployed_config(self, rendered):
+        """Store the interpolated config on the manager, so the next run could find changes beyond the running specs"""
+        f = tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False)
+        try:
+            with f:
+                yaml.safe_dump(rendered, f, default_flow_style=False)
+
+            self.host.cp(f.name, self.stack_config_path('deployed-config.yml'))
+        finally:
+            os.unlink(f.name)
+
+    def fetch_running_services(self, name):
+        """Fetch the manager environment, specs of every service in the stack and the previously deployed config with a single query"""
+        output = self.host.get_script_output(
+            "env -0; printf '\\0---\\n'; "
+            'docker service inspect $(docker service ls -q --filter label=com.docker.stack.namespace={name}) 2>/dev/null || echo []; '  # fails on empty stack
+            'echo ---; '
+            'cat {config} 2>/dev/null; true'.format(name=quote(name), config=quote(self.stack_config_path('deployed-config.yml'))),
+        )
+        env, output = output.split('\0---\n', 1)
+        specs, previous = output.split('\n---\n', 1)
+
+        return (
+            {spec['Spec']['Name']: spec['Spec'] for spec in json.loads(specs)},
+            yaml.safe_load(previous) if len(previous.strip()) else None,
+            dict(var.split('=', 1) for var in env.split('\0') if '=' in var),
+        )
+
+    @staticmethod
+    def normalize_env(env, shell_env=None):
+        """Convert docker-compose environment, either list or dict, to a dict.
+
+        Variables without a value, like FOO or FOO:, are taken from shell_env, like docker stack deploy does,
+        and skipped when they are not set there, as docker does not set them in the container either.
+        """
+        shell_env = shell_env or {}
+
+        def to_string(value):
+            if isinstance(value, bool):  # like docker stack deploy, which writes YAML booleans as true and false
+                return 'true' if value else 'false'
+
+            return str(value)
+
+        if not isinstance(env, dict):
+            env = dict(var.split('=', 1) if '=' in var else (var, None) for var in env or [])
+
+        env = {key: shell_env.get(key) if value is None else value for key, value in env.items()}
+
+        return {key: to_string(value) for key, value in env.items() if value is not None}
+
+    @classmethod
+    def service_changes(cls, wanted, running, shell_env=None):
+        """Get a list of (field, old, new) changes between a docker-compose service description and a running service spec"""
+        changes = list()
+        container = running['TaskTemplate']['ContainerSpec']
+
+        old_image, new_image = with_tag(container.get('Image')), with_tag(wanted.get('image'))
+        if old_image != new_image:
+            changes.append(('image', old_image, new_image))
+
+        old_env, new_env = cls.normalize_env(container.get('Env')), cls.normalize_env(wanted.get('environment'), shell_env)
+        if 'env_file' in wanted:  # variables from env files are set only by docker stack deploy, see other_changes
+            old_env = {key: value for key, value in old_env.items() if key in new_env}
+
+        for key in sorted(set(old_env) | set(new_env)):
+            if old_env.get(key) != new_env.get(key):
+                changes.append(('env ' + key, old_env.get(key), new_env.get(key)))
+
+        new_replicas = (wanted.get('deploy') or {}).get('replicas')
+        old_replicas = running.get('Mode', {}).get('Replicated', {}).get('Replicas')
+        if new_replicas is not None and old_replicas is not None and int(new_replicas) != old_replicas:
+            changes.append(('replicas', old_replicas, int(new_replicas)))
+
+        return changes
+
+    @staticmethod
+    def without_compared_fields(service):
+        """Service description without the fields that could be updated by docker service update"""
+        service = dict(service or {})
+        service.pop('image', None)
+        service.pop('environment', None)
+
+        if isinstance(service.get('deploy'), dict):
+            service['deploy'] = {key: value for key, value in service['deploy'].items() if key != 'replicas'}
+
+        return service
+
+    def other_changes(self, previous, rendered):
+        """Get the list of changes that could be applied only by docker stack deploy"""
+        if previous is None:
+            return ['no previously deployed config on the manager']
+
+        changes = ['{} section'.format(key) for key in sorted(set(previous) | set(rendered)) if key != 'services' and previous.get(key) != rendered.get(key)]
+
+        previous_services, services = previous.get('services') or {}, rendered.get('services') or {}
+        for service in sorted(set(previous_services) & set(services)):
+            if self.without_compared_fields(previous_services[service]) != self.without_compared_fields(services[service]):
+                changes.append('service {}'.format(service))
+
+        for service in sorted(services):
+            if 'env_file' in (services[service] or {}):  # files are read on the manager by docker stack deploy
+                changes.append('service {} env_file'.format(service))
+
+        return changes
+
+    def get_plan(self, name, services, running, shell_env=None):
+        """Get a list of (action, service, changes) tuples, where action is one of '+' (create), '~' (update) or '-' (remove)"""
+        plan = list()
+        for service in sorted(services):
+            full_name = '{stack}_{service}'.format(stack=name, service=service)
+            if full_name not in running:
+                plan.append(('+', full_name, []))
+                continue
+
+            changes = self.service_changes(services[service] or {}, running[full_name], shell_env)
+            if len(changes):
+                plan.append(('~', full_name, changes))
+
+        wanted = ['{stack}_{service}'.format(stack=name, service=service) for service in services]
+        for full_name in sorted(set(running) - set(wanted)):
+            plan.append(('-', full_name, []))
+
+        return plan
+
+    @staticmethod
+    def print_plan(name, plan, total, other_changes=()):
+        print('Plan for stack', name)
+        for action, service, changes in plan:
+            print(' ', action, service)
+            for field, old, new in changes:
+                print('     ', '{field}: {old} -> {new}'.format(field=field, old=old, new=new))
+
+        if len(other_changes):
+            print(' ', 'The whole stack will be deployed, because of changes beyond image, environment and replicas:', ', '.join(other_changes))
+        else:
+            print(' ', total - len([action for action, _, _ in plan if action != '-']), 'services unchanged')
+
+    @staticmethod
+    def update_args(changes):
+        args = list()
+        for field, old, new in changes:
+            if field == 'image':
+                args += ['--image', new]
+            elif field == 'replicas':
+                args += ['--replicas', new]
+            elif new is None:
+                args += ['--env-rm', field.split(' ', 1)[1]]
+            else:
+                args += ['--env-add', '{key}={value}'.format(key=field.split(' ', 1)[1], value=new)]
+
+        return args
+
+    def deploy(self, name, remainder):
         self.host.run(
             'docker', 'stack', 'deploy',
             '--prune',
@@ -212,25 +770,222 @@ class DeployStack(ManagerCommand):
             remainder, name,
         )
 
+    def handle(self, config, name, remainder, plan=False, full=False, **kwargs):
+        for option in ['--plan', '--full']:
+            if option in remainder:
+                self.parser.error('{option} should go before the stack name, arguments after it are passed to docker stack deploy'.format(option=option))
 
-class BuildImage(ImageCommand):
-    """Build docker image and label it with HEAD commit hash"""
+        if yaml is None:
+            assert not plan, 'Install PyYAML to get the deployment plan'
+            print('PyYAML is not installed, deploying the whole stack')
+
+            self.host.run('mkdir', '-p', self.stack_path())
+            self.host.cp(config, self.stack_config_path())
+            return self.deploy(name, remainder)
+
+        running, previous, shell_env = self.fetch_running_services(name)
+        rendered = self.render_config(config, shell_env)
+        if full:
+            self.upload_config(config)
+            self.deploy(name, remainder)
+            return self.save_deployed_config(rendered)
+
+        services = rendered.get('services') or {}
+        changes = self.get_plan(name, services, running, shell_env)
+        other_changes = self.other_changes(previous, rendered)
+        if len(remainder):  # docker service update does not know the arguments of docker stack deploy
+            other_changes.append('docker stack deploy arguments {}'.format(' '.join(flatten_args(remainder))))
+
+        self.print_plan(name, changes, len(services), other_changes)
+
+        if plan:
+            return
+
+        self.upload_config(config)
+
+        if len(other_changes) or any(action == '+' for action, _, _ in changes):  # new services are created only by the docker stack deploy
+            self.deploy(name, remainder)
+            return self.save_deployed_config(rendered)
+
+        for action, service, service_changes in changes:
+            if action == '~':
+                print('Updating', service)
+                with self.metrics.measure('service_update', service=service):
+                    self.host.run_script(' '.join(quote(arg) for arg in flatten_args([
+                        'docker', 'service', 'update',
+                        '--with-registry-auth',
+                        self.update_args(service_changes),
+                        service,
+                    ])))
+
+            if action == '-':
+                print('Removing', service)
+                with self.metrics.measure('service_removal', service=service):
+                    self.host.run('docker', 'service', 'rm', service)
+
+        self.save_deployed_config(rendered)
+
+
+class BuildCommand(ImageCommand):
+    """A command that builds docker images"""
+    CONTEXT_HASH_LABEL = 'd.context-hash'
+    HASH_CHUNK_SIZE = 1024 * 1024
 
     def pre_run_check(self):
         assert 'CIRCLECI' in os.environ, 'This script is intended to run inside the circleci.com'
 
-    def add_arguments(self, parser):
-        parser.add_argument('label', help='Docker image label, like you/prj')
-        parser.add_argument('ctx', help='Build context path')
-        parser.add_argument('-t', '--tagging-method', help="Image taggging method, 'sha1' (from circleci) or 'date'", default='sha1')
+    @staticmethod
+    def read_dockerignore(ctx):
+        try:
+            with open(path.join(ctx, '.dockerignore')) as f:
+                lines = [line.strip() for line in f]
+        except IOError:
+            return []
+
+        return [line for line in lines if len(line) and not line.startswith('#')]
+
+    @staticmethod
+    def dockerignore_regex(pattern):
+        """Translate a .dockerignore pattern to the regex. Unlike fnmatch, `*` does not match the path separator"""
+        pattern = path.normpath(pattern).lstrip('/')
+        regex, i = '', 0
+        while i < len(pattern):
+            if pattern[i:i + 3] == '**/':
+                regex, i = regex + '(.*/)?', i + 3
+            elif pattern[i:i + 2] == '**':
+                regex, i = regex + '.*', i + 2
+            elif pattern[i] == '*':
+                regex, i = regex + '[^/]*', i + 1
+            elif pattern[i] == '?':
+                regex, i = regex + '[^/]', i + 1
+            else:
+                regex, i = regex + re.escape(pattern[i]), i + 1
 
-    def docker_build(self, label, ctx, tagging_method, remainder, **kwargs):
+        return re.compile(regex + '$')
+
+    @classmethod
+    def is_ignored(cls, name, patterns):
+        """Check if a path relative to the build context is excluded by .dockerignore. The last matching pattern wins"""
+        parts = name.split('/')
+        paths = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]  # excluded directory excludes everything inside it
+
+        ignored = False
+        for pattern in patterns:
+            exclude = not pattern.startswith('!')
+            regex = cls.dockerignore_regex(pattern.lstrip('!').strip())
+            if any(regex.match(p) for p in paths):
+                ignored = exclude
+
+        return ignored
+
+    @staticmethod
+    def option_values(remainder, short, long):
+        """Get all values of a docker build option, given as -f X, -fX, --file X or --file=X"""
+        args = flatten_args(remainder)
+        values = list()
+        for i, arg in enumerate(args):
+            if arg in [short, long] and i + 1 < len(args):
+                values.append(args[i + 1])
+            elif long is not None and arg.startswith(long + '='):
+                values.append(arg[len(long) + 1:])
+            elif short is not None and arg.startswith(short) and not arg.startswith('--') and len(arg) > len(short):
+                values.append(arg[len(short):])
+
+        return values
+
+    @classmethod
+    def dockerfile_path(cls, ctx, remainder):
+        files = cls.option_values(remainder, '-f', '--file')
+        return files[-1] if len(files) else path.join(ctx, 'Dockerfile')
+
+    @classmethod
+    def context_hash(cls, ctx, remainder):
+        """Compute a hash of the build context (honoring .dockerignore), the Dockerfile and the build arguments"""
+        patterns = cls.read_dockerignore(ctx)
+        digest = hashlib.sha256()
+
+        def add(*parts):
+            for part in parts:
+                digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+                digest.update(b'\0')
+
+        add(*flatten_args(remainder))
+        for build_arg in cls.option_values(remainder, None, '--build-arg'):
+            if '=' not in build_arg:  # docker takes the value from the environment
+                add(build_arg, os.environ[build_arg] if build_arg in os.environ else '\0unset')
+
+        def relative(full_path):
+            return path.relpath(full_path, ctx).replace(os.sep, '/')
+
+        prune = not any(pattern.startswith('!') for pattern in patterns)  # exceptions could re-include files inside ignored directories
+
+        files = list()
+        for root, dirs, filenames in os.walk(ctx):
+            dirs[:] = sorted(d for d in dirs if not (prune and cls.is_ignored(relative(path.join(root, d)), patterns)))
+            for filename in filenames:
+                name = relative(path.join(root, filename))
+                if not cls.is_ignored(name, patterns):
+                    files.append(name)
+
+        dockerfile = cls.dockerfile_path(ctx, remainder)
+        for name, full_path in [('Dockerfile', dockerfile)] + [(name, path.join(ctx, name)) for name in sorted(files)]:
+            if path.islink(full_path):
+                add(name, 'link', os.readlink(full_path))
+            elif path.isfile(full_path):
+                add(name, oct(os.stat(full_path).st_mode & 0o111))
+                with open(full_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(cls.HASH_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+
+                digest.update(b'\0')
+
+        return digest.hexdigest()
+
+    @classmethod
+    def registry_hashes(cls, label):
+        """Get context hashes of the image in the registry, reading only the image config, without pulling layers"""
+        config = json.loads(run_with_output('docker', 'buildx', 'imagetools', 'inspect', '--format', '{{json .Image}}', label))
+        configs = [config] if 'config' in config else config.values()  # multi-platform images have a config per platform
+
+        return set(((image.get('config') or {}).get('Labels') or {}).get(cls.CONTEXT_HASH_LABEL) for image in configs)
+
+    @classmethod
+    def find_built_image(cls, label, context_hash):
+        """Find an image with the same context hash, locally or as the latest tag in the registry. The latter is pulled only if it matches"""
+        image, _ = label_and_tag(label)
+        local = [img for img in run_with_output(
+            'docker', 'image', 'ls', '-q',
+            '--filter', 'label={label}={hash}'.format(label=cls.CONTEXT_HASH_LABEL, hash=context_hash),
+            image,
+        ).split('\n') if len(img)]
+        if len(local):
+            return local[0]
+
+        latest = cls.label(image, 'latest')
+        try:
+            if context_hash in cls.registry_hashes(latest):
+                run('docker', 'pull', '-q', latest)
+                return latest
+        except (subprocess.CalledProcessError, OSError, ValueError):  # no buildx, no image or no access to the registry
+            pass
+
+    def docker_build(self, label, ctx, tagging_method, remainder, force=False, **kwargs):
         label = self.label(label, tagging_method=tagging_method)
+
+        context_hash = self.context_hash(ctx, remainder)
+        if not force:
+            existing = self.find_built_image(label, context_hash)
+            if existing is not None:
+                print('Build context is unchanged, tagging', existing, 'as', label)
+                run('docker', 'tag', existing, label)
+                return label
+
         print('Building', label)
 
         run(
             'docker', 'build',
             '-t', label,
+            '--label', '{label}={hash}'.format(label=self.CONTEXT_HASH_LABEL, hash=context_hash),
             remainder,
             ctx,
         )
@@ -243,6 +998,15 @@ class BuildImage(ImageCommand):
 
         run('docker', 'tag', versioned, latest)
 
+
+class BuildImage(BuildCommand):
+    """Build docker image and label it with HEAD commit hash"""
+    def add_arguments(self, parser):
+        parser.add_argument('label', help='Docker image label, like you/prj')
+        parser.add_argument('ctx', help='Build context path')
+        parser.add_argument('-t', '--tagging-method', help="Image taggging method, 'sha1' (from circleci) or 'date'", default='sha1')
+        parser.add_argument('--force', help='Build even if an image with the same build context is present', action='store_true')
+
     def handle(self, **kwargs):
         label = self.docker_build(**kwargs)
         self.tag_as_latest(label)
@@ -287,39 +1051,454 @@ class PushImage(ImageCommand):
             self.docker_push(label, **kwargs)
 
 
-class UpdateImage(ManagerCommand):
+class BuildPush(BuildCommand):
+    """Build docker images, pushing every image while the next ones are still building"""
+    def pre_run_check(self):
+        super(BuildPush, self).pre_run_check()
+        assert 'DOCKER_LOGIN' in os.environ and 'DOCKER_PASSWORD' in os.environ, \
+            'You should have $DOCKER_LOGIN and $DOCKER_PASSWORD defined in your build env'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--tagging-method', help="Image taggging method, 'sha1' (from circleci) or 'date'", default='sha1')
+        parser.add_argument('-p', '--parallel', help='Number of images to push at once', type=int, default=2)
+        parser.add_argument('--force', help='Build even if an image with the same build context is present', action='store_true')
+        parser.add_argument('images', help='Docker image labels with build context paths, like you/prj=src', nargs='+', metavar='LABEL=CTX')
+
+    @staticmethod
+    def push(labels):
+        """Push all labels of the image, returning (started, finished) timestamps"""
+        started = time.time()
+        for label in labels:
+            PushImage.docker_push(label)
+
+        return started, time.time()
+
+    @staticmethod
+    def union(intervals):
+        """Merge overlapping (started, finished) intervals, so concurrent pushes are counted once"""
+        merged = list()
+        for started, finished in sorted(intervals):
+            if len(merged) and started <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], finished))
+            else:
+                merged.append((started, finished))
+
+        return merged
+
+    @classmethod
+    def overlap(cls, builds, pushes):
+        """Seconds of pushing that ran at the same time as building. Builds are sequential, so they never overlap each other"""
+        return sum(
+            max(0, min(build_finished, push_finished) - max(build_started, push_started))
+            for build_started, build_finished in builds
+            for push_started, push_finished in cls.union(pushes)
+        )
+
+    def handle(self, images, tagging_method='sha1', parallel=2, force=False, remainder=(), **kwargs):
+        PushImage.docker_login()
+
+        started = time.time()
+        builds, pushing = list(), list()
+        pool = ThreadPool(max(1, parallel))
+        try:
+            for label, ctx in [image.split('=', 1) for image in images]:
+                build_started = time.time()
+                versioned = self.docker_build(label, ctx, tagging_method, remainder, force=force)
+                self.tag_as_latest(versioned)
+                builds.append((build_started, time.time()))
+
+                pushing.append(pool.apply_async(self.push, [[versioned, self.label(versioned, 'latest')]]))
+
+            pushes = [push.get() for push in pushing]  # re-raises push errors
+        finally:
+            pool.close()
+            pool.join()  # pushes of the images built before a failed build are finished too
+
+        building = sum(end - begin for begin, end in builds)
+        pushing = sum(end - begin for begin, end in self.union(pushes))  # time spent pushing, concurrent pushes counted once
+        print('Built {count} images in {building:.1f}s and pushed them in {pushing:.1f}s, {overlap:.1f}s of pushing overlapped with building'.format(
+            count=len(builds),
+            building=building,
+            pushing=pushing,
+            overlap=self.overlap(builds, pushes),
+        ))
+        print('Total {total:.1f}s instead of {serial:.1f}s'.format(total=time.time() - started, serial=building + pushing))
+
+
+class UpdateImage(StackCommand):
     """Update image in the running stack"""
+    def __init__(self):
+        super(UpdateImage, self).__init__()
+
+        self.digests = dict()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-pin', help='Do not pin services to the image digest, letting swarm resolve the tag', action='store_true')
+        parser.add_argument('--all-stacks', help='Update services running the image in every stack. Pass only the image name', action='store_true')
+        parser.add_argument('-l', '--label', help='Like --all-stacks, but only services with this label, like com.example.role=worker')
+        parser.add_argument('name', help='Stack name, or the image name with --all-stacks and --label')
+        parser.add_argument('image', help='Image name, omitted with --all-stacks and --label', nargs='?')
+
+    def get_stacks(self, image, label=None):
+        """Get services running the image across all stacks, as ({stack: [services]}, {service: current image})"""
+        image = with_tag(image).rsplit(':', 1)[0]  # only image name
+
+        stacks, images = dict(), dict()
+        for stack, service, service_image in self.fetch_all_services(label):
+            if len(stack) and with_tag(service_image).rsplit(':', 1)[0] == image:  # services outside of stacks are not updated
+                stacks.setdefault(stack, []).append(service)
+                images[service] = service_image
+
+        return {stack: sorted(services) for stack, services in stacks.items()}, images
+
+    @staticmethod
+    def local_registry_digest(image):
+        return json.loads(run_with_output('docker', 'buildx', 'imagetools', 'inspect', '--format', '{{json .Manifest}}', image))['digest']
+
+    def manager_registry_digest(self, image):
+        return json.loads(self.host.get_script_output(
+            "docker buildx imagetools inspect --format '{{{{json .Manifest}}}}' {image}".format(image=quote(image)),
+        ))['digest']
+
+    def find_digest(self, image):
+        """Ask the registry for the digest of the image, from here or through the manager, without pulling it.
+
+        Locally cached images are never used, as they could be older than the tag in the registry.
+        """
+        for registry_digest in [self.local_registry_digest, self.manager_registry_digest]:
+            try:
+                return registry_digest(image)
+            except (subprocess.CalledProcessError, OSError, ValueError, KeyError, TypeError):
+                continue
+
+    def resolve_digest(self, image):
+        """Get the image pinned to its digest, like org/img:latest@sha256:..., resolving every image once per run"""
+        if '@' in image:  # already pinned
+            return image
+
+        if image not in self.digests:
+            self.digests[image] = self.find_digest(image)
+
+        if self.digests[image] is None:
+            print('Could not resolve the digest of', image, 'updating by tag')
+            return image
+
+        name, tag = label_and_tag(image)
+        return '{name}:{tag}@{digest}'.format(name=name, tag=tag or 'latest', digest=self.digests[image])
+
+    def fetch_images(self, services):
+        """Get current images of the services with a single query"""
+        return dict(line.split('|') for line in self.host.get_output(
+            'docker', 'service', 'inspect', services,
+            '--format', '"{{ .Spec.Name }}|{{ .Spec.TaskTemplate.ContainerSpec.Image }}"',
+        ))
+
+    def save_snapshot(self, name, image, services, images=None):
+        """Record current images of the services, locally and on the manager, so the rollback command could restore them"""
+        images = images if images is not None else self.fetch_images(services)
+        previous = {service: service_image for service, service_image in images.items() if service_image != image}
+        if not len(previous):
+            return
+
+        run_id = self.run_id()
+        if run_id is not None:
+            existing = self.load_snapshot(name)
+            if existing is not None and existing.get('run') == run_id:  # keep images recorded before the run started
+                previous.update(existing['services'])
+
+        snapshot = self.local_snapshot_path(name)
+        if not path.exists(path.dirname(snapshot)):
+            os.makedirs(path.dirname(snapshot))
+
+        with open(snapshot, 'w') as f:
+            json.dump(dict(stack=name, image=image, run=run_id, created=datetime.now().isoformat(), services=previous), f, indent=2, sort_keys=True)
+
+        self.host.run('mkdir', '-p', path.dirname(self.remote_snapshot_path(name)))
+        self.host.cp(snapshot, self.remote_snapshot_path(name))
+        print('Previous images saved to', snapshot)
+
+    def handle(self, name, image, remainder, no_pin=False, all_stacks=False, label=None, **kwargs):
+        across_stacks = all_stacks or label is not None
+        if across_stacks and image is not None:
+            self.parser.error('--all-stacks and --label take only the image name')
+
+        if not across_stacks and image is None:
+            self.parser.error('the following arguments are required: image')
+
+        if across_stacks:
+            image = name  # the only positional argument is the image
+            stacks, images = self.get_stacks(image, label)
+        else:
+            services = list(self.get_services(name, image))
+            stacks, images = {name: services} if len(services) else {}, None
+
+        pinned = image if no_pin or not len(stacks) else self.resolve_digest(image)
+
+        for stack, services in sorted(stacks.items()):
+            self.save_snapshot(stack, pinned, services, images={service: images[service] for service in services} if images else None)
+
+        for stack, services in sorted(stacks.items()):
+            if across_stacks:
+                print('Stack', stack)
+
+            for service in services:
+                print('Updating', service, 'to image', pinned)
+                with self.metrics.measure('service_update', stack=stack, service=service):
+                    self.host.run(
+                        'docker', 'service', 'update',
+                        '--with-registry-auth',
+                        '--image', pinned,
+                        remainder, service,
+                    )
+
+        if across_stacks:
+            print('Updated', sum(len(services) for services in stacks.values()), 'services in', len(stacks), 'stacks:')
+            for stack, services in sorted(stacks.items()):
+                print('     ', stack, '\t', ', '.join(services))
+
+
+class Rollback(StackCommand):
+    """Restore images of the stack services saved by the last update-image"""
     def add_arguments(self, parser):
         parser.add_argument('name', help='Stack name')
-        parser.add_argument('image', help='Image name')
 
-    def fetch_services(self, stack_name):
-        for service in self.host.get_output(
-            'docker', 'stack', 'services',
-            stack_name,
-            '--format', '"{{ .Name }}|{{ .Image }}"',
-        ):
-            yield service.split('|')
+    @staticmethod
+    def rollback_script(services, remainder=()):
+        """Shell script that updates all services concurrently and fails if any of the updates fails"""
+        lines = ['failed=0']
+        for i, (service, image) in enumerate(sorted(services.items())):
+            args = ['docker', 'service', 'update', '--with-registry-auth', '--no-resolve-image', '--image', image] + flatten_args(remainder) + [service]
+            lines.append('{command} >/dev/null & pid{i}=$!'.format(command=' '.join(quote(arg) for arg in args), i=i))
+
+        for i, service in enumerate(sorted(services)):
+            lines.append('wait $pid{i} && echo {service} restored || {{ echo {service} failed; failed=1; }}'.format(i=i, service=quote(service)))
+
+        return '\n'.join(lines + ['exit $failed'])
+
+    def handle(self, name, remainder, **kwargs):
+        snapshot = self.load_snapshot(name)
+        if snapshot is None:
+            print('No image snapshot found for stack', name)
+            exit(127)
 
-    def get_services(self, name, image):
-        image, _ = label_and_tag(image)  # only image name
+        print('Rolling back', ', '.join(sorted(snapshot['services'])), 'to images recorded at', snapshot['created'])
 
-        for service, image_name in self.fetch_services(name):
-            service_image, _ = label_and_tag(image_name)
+        with self.metrics.measure('rollback', stack=name):
+            self.host.run_script(self.rollback_script(snapshot['services'], remainder))
 
-            if service_image == image:
-                yield service
 
-    def handle(self, name, image, remainder, **kwargs):
-        for service in self.get_services(name, image):
-            print('Updating', service, 'to image', image)
-            self.host.run(
-                'docker', 'service', 'update',
-                '--with-registry-auth',
-                '--image', image,
-                remainder, service,
+class Logs(StackCommand):
+    """Stream logs of every service in the stack"""
+    MAX_LINE_LENGTH = 16 * 1024
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--image', help='Show only services running this image')
+        parser.add_argument('-f', '--follow', help='Follow log output', action='store_true')
+        parser.add_argument('--since', help='Show logs since timestamp or relative time, like 42m')
+        parser.add_argument('--tail', help='Number of lines to show from the end of each service logs', default='100')
+        parser.add_argument('--buffer', help='Maximum number of lines to keep while the output is slow', type=int, default=10000)
+        parser.add_argument('name', help='Stack name')
+
+    @staticmethod
+    def logs_script(services, follow=False, since=None, tail='100'):
+        """Shell script that streams logs of all services concurrently within a single connection.
+
+        Every docker service logs process writes whole lines, prefixed with the service name and the task,
+        so the lines from different services are interleaved but never mixed.
+        """
+        args = ['--tail', quote(str(tail))]
+        if follow:
+            args.append('--follow')
+
+        if since is not None:
+            args += ['--since', quote(since)]
+
+        commands = ['docker service logs {args} {service} 2>&1 & pid{i}=$!;'.format(args=' '.join(args), service=quote(service), i=i) for i, service in enumerate(services)]
+        waits = ['wait $pid{i} || failed=1;'.format(i=i) for i in range(len(services))]
+
+        return ' '.join(['failed=0;'] + commands + waits + ['exit $failed'])
+
+    @classmethod
+    def read_lines(cls, stream, buffer):
+        """Read the process output as fast as possible, so the remote side never waits for the local output"""
+        for line in iter(lambda: stream.readline(cls.MAX_LINE_LENGTH), b''):
+            buffer.put(line.decode('utf-8', 'replace').rstrip('\n'))
+
+        buffer.close()
+
+    def handle(self, name, image=None, follow=False, since=None, tail='100', buffer=10000, **kwargs):
+        services = list(self.get_services(name, image))
+        if not len(services):
+            print('No services found in stack', name)
+            exit(127)
+
+        print('Streaming logs of', ', '.join(services))
+        process = self.host.stream(self.logs_script(services, follow=follow, since=since, tail=tail))
+
+        lines = LineBuffer(buffer)
+        reader = threading.Thread(target=self.read_lines, args=(process.stdout, lines))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            for line in lines:
+                print(line)
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+            exit(130)
+
+        code = process.wait()
+        if code != 0:
+            print('Streaming logs failed with exit code', code)
+            exit(code)
+
+
+class PruneImages(ManagerCommand):
+    """Remove old image tags on every swarm node"""
+    VERSION_TAG = re.compile(r'^([0-9a-f]{40}|[0-9]{12})$')  # sha1 and date tags, made by build-image
+    DOCKER_SOCKET = '/var/run/docker.sock'
+    IMAGES_SCRIPT = ' '.join([
+        'for image in $(docker image ls -q --no-trunc | sort -u); do',
+        "echo \"$(docker image inspect --format '{{.Id}}|{{.Size}}|{{.Created}}|{{json .RepoTags}}|{{json .RootFS.Layers}}' $image)"
+        "|$(docker history -H=false --format '{{.Size}}' $image | tr '\\n' ' ')\";",
+        'done',
+    ])
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--image', help='Image name to prune, like you/prj. Default is every image', action='append', dest='images', default=[])
+        parser.add_argument('-k', '--keep', help='Number of the latest sha1 or date tags to keep for every image', type=int, default=5)
+        parser.add_argument('-p', '--parallel', help='Number of nodes to prune at once', type=int, default=4)
+        parser.add_argument('--docker-image', help='Image with docker CLI, run on every node as a one-off service to reach its docker', default='docker:cli')
+        parser.add_argument('--dry-run', help='Only report what would be removed', action='store_true')
+
+    def fetch_used_images(self):
+        """Get image tags used by every service in the swarm"""
+        return set(with_tag(image) for image in self.host.get_output('docker', 'service', 'ls', '--format', '"{{.Image}}"'))
+
+    def node_script(self, node, script, docker_image):
+        """Shell script running the given one on the node within a one-off swarm service, that talks to the node docker through its socket"""
+        return self.job_script([
+            '--mount', 'type=bind,source={socket},target={socket}'.format(socket=self.DOCKER_SOCKET),
+            docker_image,
+            'sh', '-c', quote(script),
+        ], node=node)
+
+    @staticmethod
+    def layer_sizes(layers, history):
+        """Match layer sizes from docker history, newest entry first, to the image layers, oldest first.
+
+        Entries without a layer, like ENV, have zero size, so only the non-zero ones are matched in order.
+        Layers without any files are zero-sized too, and are matched last.
+        """
+        sizes = [size for size in reversed(history) if size > 0][:len(layers)]
+        return dict(zip(layers, sizes + [0] * (len(layers) - len(sizes))))
+
+    def fetch_images(self, node, docker_image):
+        """Get all images on the node with sizes of their layers, an image with many tags is listed once"""
+        images = dict()
+        for line in self.host.get_script_output(self.node_script(node, self.IMAGES_SCRIPT, docker_image)).split('\n'):
+            if not len(line.strip()):
+                continue
+
+            image_id, size, created, tags, layers, history = line.split('|')
+            images[image_id] = dict(
+                id=image_id,
+                size=int(size),
+                created=created,
+                tags=json.loads(tags) or [],
+                layers=self.layer_sizes(json.loads(layers) or [], [int(entry) for entry in history.split()]),
             )
 
+        return list(images.values())
+
+    @classmethod
+    def select(cls, images, used, keep, names=None):
+        """Get tags to remove and the number of bytes their removal frees.
+
+        Only sha1 and date tags are removed, keeping the `keep` latest ones for every image and the ones used by services.
+        An image is freed only when all its tags are removed, and only the layers no kept image uses are counted.
+        """
+        versions = dict()
+        for image in images:
+            for tag in image['tags']:
+                name, version = tag.rsplit(':', 1)
+                if (not names or name in names) and cls.VERSION_TAG.match(version):
+                    versions.setdefault(name, []).append((image['created'], tag))
+
+        remove = set()
+        for name, tags in versions.items():
+            for created, tag in sorted(tags, reverse=True)[keep:]:
+                if tag not in used:
+                    remove.add(tag)
+
+        def layers(image):
+            return image.get('layers') or {image['id']: image['size']}
+
+        removed = [image for image in images if len(image['tags']) and all(tag in remove for tag in image['tags'])]
+        kept = set(layer for image in images if image not in removed for layer in layers(image))
+        freed = dict((layer, size) for image in removed for layer, size in layers(image).items() if layer not in kept)
+
+        return sorted(remove), sum(freed.values())
+
+    @staticmethod
+    def human_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if size < 1024:
+                return '{size:.1f} {unit}'.format(size=size, unit=unit)
+
+            size = size / 1024.0
+
+        return '{size:.1f} TB'.format(size=size)
+
+    def prune_node(self, node, used, keep, names, dry_run, docker_image):
+        """Prune images on a single node, returning (hostname, removed tags, freed bytes, error)"""
+        hostname = node['Description']['Hostname']
+        try:
+            tags, freed = self.select(self.fetch_images(node, docker_image), used, keep, names)
+            if len(tags) and not dry_run:
+                self.host.run_script(self.node_script(node, ' '.join(['docker', 'image', 'rm'] + [quote(tag) for tag in tags]), docker_image))
+
+        except subprocess.CalledProcessError as e:
+            return hostname, [], 0, e
+
+        return hostname, tags, freed, None
+
+    def handle(self, images=None, keep=5, parallel=4, dry_run=False, docker_image='docker:cli', **kwargs):
+        nodes, _ = self.fetch_nodes()
+        nodes = [node for node in nodes if node['Status']['State'] == 'ready' and node['Spec']['Availability'] == 'active']  # one-off services are not placed on drained nodes
+        used = self.fetch_used_images()
+
+        if not self.host.is_local():
+            self.host.control_path = path.join(tempfile.gettempdir(), 'd-ssh-%C')
+
+        pool = ThreadPool(max(1, min(parallel, len(nodes))))
+        try:
+            results = pool.imap_unordered(lambda node: self.prune_node(node, used, keep, images, dry_run, docker_image), nodes)
+            total, failed = 0, 0
+            for hostname, tags, freed, error in results:
+                if error is not None:
+                    print(hostname, 'failed:', error)
+                    failed += 1
+                    continue
+
+                total += freed
+                print(hostname, '{action} {count} tags, freeing up to {size}'.format(
+                    action='would remove' if dry_run else 'removed',
+                    count=len(tags),
+                    size=self.human_size(freed),
+                ))
+                for tag in tags:
+                    print('     ', tag)
+
+        finally:
+            pool.close()
+
+        print('Total: up to', self.human_size(total), 'would be freed' if dry_run else 'freed')
+
+        if failed:
+            exit(1)
+
 
 class AddHostKey(BaseCommand):
     """Add host key to .ssh/known_hosts storage"""
@@ -346,18 +1525,129 @@ class RunCommand(ManagerCommand):
     def add_arguments(self, parser):
         parser.add_argument('--env-from', help='Take envirnoment variables from specified service', default='')
         parser.add_argument('-i', '--image', help='Image to run the command')
+        parser.add_argument('-n', '--node', help="Swarm node to run the command on as a one-off service, 'auto' to pick the least loaded one. Default is the manager")
+        parser.add_argument('--jobs', help='File with arguments of a single job per line, - for stdin. Jobs run concurrently, with arguments appended to the command')
+        parser.add_argument('-p', '--parallel', help='Number of jobs to run at once', type=int, default=4)
         parser.add_argument('command', help='Command to run within container')
 
-    def handle(self, env_from, image, command, remainder, **kwargs):
+    def handle(self, env_from, image, command, remainder, node=None, jobs=None, parallel=4, **kwargs):
         """TODO(f213): add an ability to attach to a network"""
         env = self.get_env(env_from) if len(env_from) else {}
         env = ["-e{key}={value}".format(key=key, value=value) for key, value in env.items()]
 
-        self.host.run(
-            'docker', 'run', '-t',
-            env, image, command,
-            remainder,
-        )
+        target = None if node is None else self.get_target_node(node)
+
+        if jobs is not None:
+            return self.run_jobs([env, image, command, remainder], self.read_jobs(jobs), parallel, image=image, node=target)
+
+        if target is not None:
+            with self.metrics.measure('job', image=image, host=target['Description']['Hostname']):
+                return self.host.run_script(self.job_script([env, image, command, remainder], node=target))
+
+        with self.metrics.measure('job', image=image, host=self.host.name):
+            self.host.run(
+                'docker', 'run', '-t',
+                env, image, command,
+                remainder,
+            )
+
+    @staticmethod
+    def node_load(node, tasks):
+        """Get (available cpus, available memory bytes, running tasks) of the node. Resources reserved by the running tasks are not available"""
+        resources, running = node['Description']['Resources'], tasks.get(node['ID'], dict(tasks=0, cpus=0, memory=0))
+        return max(resources['NanoCPUs'] - running['cpus'], 0) / 1e9, max(resources['MemoryBytes'] - running['memory'], 0), running['tasks']
+
+    @classmethod
+    def choose_node(cls, nodes, tasks):
+        """Choose the node with the most available CPU and memory per running task. Workers are preferred over managers"""
+        nodes = [node for node in nodes if node['Status']['State'] == 'ready' and node['Spec']['Availability'] == 'active']
+        assert len(nodes), 'No available swarm nodes found'
+
+        workers = [node for node in nodes if node['Spec']['Role'] == 'worker']
+        if len(workers):
+            nodes = workers
+
+        def share(node):
+            cpus, memory, running = cls.node_load(node, tasks)
+            return cpus / (running + 1), float(memory) / (running + 1)
+
+        max_cpus = max(share(node)[0] for node in nodes) or 1
+        max_memory = max(share(node)[1] for node in nodes) or 1
+
+        def score(node):
+            cpus, memory = share(node)
+            return cpus / max_cpus + memory / max_memory
+
+        return sorted(nodes, key=lambda node: (-score(node), node['Description']['Hostname']))[0]
+
+    def get_target_node(self, node):
+        """Get the swarm node to run the command on"""
+        nodes, tasks = self.fetch_nodes()
+
+        if node == 'auto':
+            target = self.choose_node(nodes, tasks)
+        else:
+            target = [n for n in nodes if node in [n['ID'], n['Description']['Hostname']]]
+            assert len(target), 'Node {} not found in the swarm'.format(node)
+            target = target[0]
+
+        cpus, memory, running = self.node_load(target, tasks)
+        print('Running on {hostname} ({cpus:g} CPUs, {memory} MB memory available, {running} running tasks)'.format(
+            hostname=target['Description']['Hostname'],
+            cpus=cpus,
+            memory=memory // 1024 // 1024,
+            running=running,
+        ))
+
+        return target
+
+    @staticmethod
+    def read_jobs(jobs):
+        """Read job arguments, one job per line. Empty lines and comments are skipped"""
+        if jobs == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(jobs) as f:
+                lines = f.readlines()
+
+        return [line.strip() for line in lines if len(line.strip()) and not line.strip().startswith('#')]
+
+    def run_job(self, args, job, image=None, node=None):
+        """Run a single job, printing its output prefixed with the job arguments. Returns (job, exit code, seconds)"""
+        started = time.time()
+        process = self.host.stream(self.job_script([args, job], node=node))  # job arguments are shell text, like the command itself
+
+        for line in iter(process.stdout.readline, b''):
+            with self.output_lock:
+                print('[{job}]'.format(job=job), line.decode('utf-8', 'replace').rstrip())
+
+        code = process.wait()
+        duration = time.time() - started
+        self.metrics.record('job', dict(image=image, host=self.host.name if node is None else node['Description']['Hostname'], job=job), duration, code == 0)
+
+        return job, code, duration
+
+    def run_jobs(self, args, jobs, parallel, image=None, node=None):
+        """Run jobs concurrently over a single shared ssh connection, exiting with 1 if any of the jobs failed"""
+        if not self.host.is_local():
+            self.host.control_path = path.join(tempfile.gettempdir(), 'd-ssh-%C')
+
+        self.output_lock = threading.Lock()
+        pool = ThreadPool(max(1, min(parallel, len(jobs))))
+        try:
+            results = pool.map(lambda job: self.run_job(args, job, image=image, node=node), jobs)
+        finally:
+            pool.close()
+
+        print('Exit code\tDuration\tJob')
+        for job, code, duration in results:
+            print('{code}\t\t{duration:.1f}s\t\t{job}'.format(code=code, duration=duration, job=job))
+
+        failed = len([code for _, code, _ in results if code != 0])
+        print(len(results) - failed, 'jobs succeeded,', failed, 'failed')
+
+        if failed:
+            exit(1)
 
     def get_env(self, env_from):
         got = self.host.get_json('docker', 'service', 'inspect', env_from)[0]
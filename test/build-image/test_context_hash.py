@@ -0,0 +1,118 @@
+import pytest
+
+
+@pytest.fixture
+def ctx(tmpdir):
+    tmpdir.join('Dockerfile').write('FROM python')
+    tmpdir.join('app.py').write('print(1)')
+    tmpdir.join('docs').mkdir().join('index.md').write('# docs')
+    tmpdir.join('.dockerignore').write('docs\n*.md\n')
+
+    return tmpdir
+
+
+@pytest.mark.parametrize('name, patterns, expected', [
+    ['docs/index.md', ['docs'], True],
+    ['docs/index.md', ['*.md'], False],
+    ['README.md', ['*.md'], True],
+    ['docs/index.md', ['**/*.md'], True],
+    ['README.md', ['**/*.md'], True],
+    ['docs/index.md', ['docs', '!docs/index.md'], False],
+    ['app.py', ['docs'], False],
+    ['app.py', ['/app.py'], True],
+])
+def test_is_ignored(command, name, patterns, expected):
+    assert command.is_ignored(name, patterns) is expected
+
+
+def test_stable(command, ctx):
+    assert command.context_hash(str(ctx), []) == command.context_hash(str(ctx), [])
+
+
+def test_ignored_files_do_not_change_the_hash(command, ctx):
+    before = command.context_hash(str(ctx), [])
+
+    ctx.join('docs', 'index.md').write('# updated docs')
+    ctx.join('README.md').write('# readme')
+
+    assert command.context_hash(str(ctx), []) == before
+
+
+@pytest.mark.parametrize('change', [
+    lambda ctx: ctx.join('app.py').write('print(2)'),
+    lambda ctx: ctx.join('Dockerfile').write('FROM python:3'),
+    lambda ctx: ctx.join('new.py').write(''),
+])
+def test_context_changes(command, ctx, change):
+    before = command.context_hash(str(ctx), [])
+
+    change(ctx)
+
+    assert command.context_hash(str(ctx), []) != before
+
+
+def test_build_args_change_the_hash(command, ctx):
+    assert command.context_hash(str(ctx), ['--build-arg', 'a=b']) != command.context_hash(str(ctx), ['--build-arg', 'a=c'])
+
+
+def test_ignored_directories_are_not_walked(command, ctx, mocker):
+    ctx.join('node_modules').mkdir().join('lib.js').write('')
+    ctx.join('.dockerignore').write('docs\n*.md\nnode_modules\n')
+    is_ignored = mocker.spy(command, 'is_ignored')
+
+    command.context_hash(str(ctx), [])
+
+    assert 'node_modules/lib.js' not in [c[0][0] for c in is_ignored.call_args_list]
+
+
+def test_exceptions_inside_ignored_directories(command, ctx):
+    ctx.join('.dockerignore').write('docs\n!docs/index.md\n')
+    before = command.context_hash(str(ctx), [])
+
+    ctx.join('docs', 'index.md').write('# updated docs')
+
+    assert command.context_hash(str(ctx), []) != before
+
+
+def test_large_files_are_hashed_in_chunks(command, ctx, mocker):
+    mocker.patch.object(command, 'HASH_CHUNK_SIZE', 4)
+    before = command.context_hash(str(ctx), [])
+
+    ctx.join('app.py').write('print(1) ')
+
+    assert command.context_hash(str(ctx), []) != before
+
+
+@pytest.mark.parametrize('remainder, expected', [
+    [[], 'Dockerfile'],
+    [['-f', '../Dockerfile'], '../Dockerfile'],
+    [['--file', '../Dockerfile'], '../Dockerfile'],
+    [['--file=../Dockerfile'], '../Dockerfile'],
+    [['-f../Dockerfile'], '../Dockerfile'],
+    [['--build-arg', 'a=b', '--file=../Dockerfile'], '../Dockerfile'],
+])
+def test_dockerfile_path(command, remainder, expected):
+    assert command.dockerfile_path('', remainder) == expected
+
+
+@pytest.mark.parametrize('option', [['--file={}'], ['-f{}'], ['--file', '{}'], ['-f', '{}']])
+def test_dockerfile_outside_of_the_context_changes_the_hash(command, ctx, tmpdir_factory, option):
+    dockerfile = tmpdir_factory.mktemp('outside').join('Dockerfile')
+    dockerfile.write('FROM python')
+    remainder = [arg.format(str(dockerfile)) for arg in option]
+    before = command.context_hash(str(ctx), remainder)
+
+    dockerfile.write('FROM python:3')
+
+    assert command.context_hash(str(ctx), remainder) != before
+
+
+def test_build_args_from_the_environment_change_the_hash(command, ctx, monkeypatch):
+    monkeypatch.setenv('VERSION', '1')
+    before = command.context_hash(str(ctx), ['--build-arg', 'VERSION'])
+
+    monkeypatch.setenv('VERSION', '2')
+    assert command.context_hash(str(ctx), ['--build-arg', 'VERSION']) != before
+
+    monkeypatch.delenv('VERSION')
+    assert command.context_hash(str(ctx), ['--build-arg', 'VERSION']) != before
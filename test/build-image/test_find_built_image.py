@@ -0,0 +1,51 @@
+import json
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def output(mocker):
+    return mocker.patch('d.run_with_output', return_value='')
+
+
+@pytest.fixture
+def registry_hashes(mocker):
+    return mocker.patch('d.BuildImage.registry_hashes', return_value={'c0ffee'})
+
+
+def test_local(command, output, run, registry_hashes):
+    output.return_value = 'localid\n'
+
+    assert command.find_built_image('org/img:testsha1', 'c0ffee') == 'localid'
+    registry_hashes.assert_not_called()
+
+
+def test_registry_match_is_pulled(command, output, run, registry_hashes):
+    assert command.find_built_image('org/img:testsha1', 'c0ffee') == 'org/img:latest'
+
+    registry_hashes.assert_called_once_with('org/img:latest')
+    run.assert_called_once_with(['docker', 'pull', '-q', 'org/img:latest'])
+
+
+def test_registry_miss_is_not_pulled(command, output, run, registry_hashes):
+    assert command.find_built_image('org/img:testsha1', 'deadbeef') is None
+
+    run.assert_not_called()
+
+
+def test_registry_errors(command, output, run, registry_hashes):
+    registry_hashes.side_effect = subprocess.CalledProcessError(1, 'docker')
+
+    assert command.find_built_image('org/img:testsha1', 'c0ffee') is None
+
+
+@pytest.mark.parametrize('config', [
+    {'config': {'Labels': {'d.context-hash': 'c0ffee'}}},
+    {'linux/amd64': {'config': {'Labels': {'d.context-hash': 'c0ffee'}}}, 'linux/arm64': {'config': {'Labels': None}}},
+])
+def test_registry_hashes(command, output, config):
+    output.return_value = json.dumps(config)
+
+    assert 'c0ffee' in command.registry_hashes('org/img:latest')
+    output.assert_called_once_with('docker', 'buildx', 'imagetools', 'inspect', '--format', '{{json .Image}}', 'org/img:latest')
@@ -6,6 +6,11 @@ def tag_as_latest(mocker):
     return mocker.patch('d.BuildImage.tag_as_latest', return_value=True)
 
 
+@pytest.fixture(autouse=True)
+def find_built_image(mocker):
+    return mocker.patch('d.BuildImage.find_built_image', return_value=None)
+
+
 def test(command, run, args_in_call):
     command.handle(
         label='org/img',
@@ -18,3 +23,28 @@ def test(command, run, args_in_call):
 
     assert args_in_call(['docker', 'build', '-t', 'org/img:testsha1'], call)
     assert args_in_call(['--build-arg', 'foo=bar', 'src'], call)
+
+
+def test_context_hash_label(command, run, args_in_call, mocker):
+    mocker.patch('d.BuildImage.context_hash', return_value='c0ffee')
+
+    command.handle(label='org/img', ctx='src', tagging_method='sha1', remainder=[])
+
+    assert args_in_call(['--label', 'd.context-hash=c0ffee'], run.call_args[0][0])
+
+
+def test_unchanged_context_is_retagged(command, run, find_built_image):
+    find_built_image.return_value = 'org/img:latest'
+
+    command.handle(label='org/img', ctx='src', tagging_method='sha1', remainder=[])
+
+    run.assert_called_once_with(['docker', 'tag', 'org/img:latest', 'org/img:testsha1'])
+
+
+def test_force(command, run, find_built_image, args_in_call):
+    find_built_image.return_value = 'org/img:latest'
+
+    command.handle(label='org/img', ctx='src', tagging_method='sha1', remainder=[], force=True)
+
+    assert args_in_call(['docker', 'build'], run.call_args[0][0])
+    find_built_image.assert_not_called()
@@ -0,0 +1,15 @@
+import pytest
+from d import BuildPush
+
+
+@pytest.fixture
+def command(mock_command):
+    return mock_command(BuildPush)
+
+
+@pytest.fixture(autouse=True)
+def prepare_environment(monkeypatch):
+    monkeypatch.setenv('CIRCLECI', 'true')
+    monkeypatch.setenv('CIRCLE_SHA1', 'testsha1')
+    monkeypatch.setenv('DOCKER_LOGIN', 'mockuser')
+    monkeypatch.setenv('DOCKER_PASSWORD', 'mockpw')
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def find_built_image(mocker):
+    return mocker.patch('d.BuildPush.find_built_image', return_value=None)
+
+
+@pytest.fixture(autouse=True)
+def context_hash(mocker):
+    return mocker.patch('d.BuildPush.context_hash', return_value='c0ffee')
+
+
+def call(command, **kwargs):
+    command.handle(images=['org/web=src/web', 'org/worker=src/worker'], remainder=['--build-arg', 'foo=bar'], **kwargs)
+
+
+def commands(run):
+    return [c[0][0] for c in run.call_args_list]
+
+
+def test_login_once_before_everything(command, run):
+    call(command)
+
+    assert commands(run)[0][:2] == ['docker', 'login']
+    assert len([c for c in commands(run) if c[:2] == ['docker', 'login']]) == 1
+
+
+def test_every_image_is_built_and_pushed(command, run, args_in_call):
+    call(command)
+
+    assert any(args_in_call(['docker', 'build', '-t', 'org/web:testsha1'], c) and args_in_call(['--build-arg', 'foo=bar', 'src/web'], c) for c in commands(run))
+    assert any(args_in_call(['docker', 'build', '-t', 'org/worker:testsha1'], c) for c in commands(run))
+
+    for label in ['org/web:testsha1', 'org/web:latest', 'org/worker:testsha1', 'org/worker:latest']:
+        assert ['docker', 'push', label] in commands(run)
+
+
+def test_push_starts_before_the_next_build(command, run, mocker):
+    """The first image is pushed while the second one is still building"""
+    pushed = threading.Event()
+
+    def _run(args):
+        if args[:3] == ['docker', 'push', 'org/web:latest']:
+            pushed.set()
+
+        if args[:2] == ['docker', 'build'] and 'org/worker:testsha1' in args:
+            assert pushed.wait(5)
+
+    run.side_effect = _run
+
+    call(command)
+
+    assert pushed.is_set()
+
+
+def test_push_errors_are_raised(command, run):
+    def _run(args):
+        if args[:2] == ['docker', 'push']:
+            raise RuntimeError('push failed')
+
+    run.side_effect = _run
+
+    with pytest.raises(RuntimeError):
+        call(command)
+
+
+@pytest.mark.parametrize('builds, pushes, expected', [
+    [[(0, 10), (10, 20)], [(10, 15), (20, 25)], 5],
+    [[(0, 10), (10, 20)], [(10, 25)], 10],
+    [[(0, 10)], [(10, 15)], 0],
+    [[(0, 10), (10, 20)], [(10, 18), (12, 20)], 10],  # concurrent pushes during one build are counted once
+    [[(0, 10), (10, 20), (20, 30)], [(10, 25), (20, 35)], 20],
+])
+def test_overlap(command, builds, pushes, expected):
+    assert command.overlap(builds, pushes) == expected
+
+
+def test_union(command):
+    assert command.union([(12, 20), (10, 18), (25, 30), (30, 31)]) == [(10, 20), (25, 31)]
+
+
+def test_pushes_are_finished_when_a_build_fails(command, run, mocker):
+    pushed = threading.Event()
+
+    def _run(args):
+        if args[:2] == ['docker', 'push']:
+            time.sleep(0.1)
+            pushed.set()
+
+        if args[:2] == ['docker', 'build'] and args[-1] == 'src2':
+            raise RuntimeError('build failed')
+
+    run.side_effect = _run
+
+    with pytest.raises(RuntimeError):
+        command.handle(images=['org/img=src1', 'org/other=src2'])
+
+    assert pushed.is_set()
@@ -0,0 +1,29 @@
+import pytest
+from d import DeployStack
+
+
+@pytest.fixture
+def command(mock_command):
+    command = mock_command(DeployStack)
+    command.args['name'] = 'mystack'
+    return command
+
+
+@pytest.fixture
+def running_spec():
+    def _running_spec(image='org/img:1', env=None, replicas=1):
+        return {
+            'TaskTemplate': {
+                'ContainerSpec': {
+                    'Image': image + '@sha256:abcdef',
+                    'Env': env or [],
+                },
+            },
+            'Mode': {
+                'Replicated': {
+                    'Replicas': replicas,
+                },
+            },
+        }
+
+    return _running_spec
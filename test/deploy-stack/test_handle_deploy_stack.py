@@ -0,0 +1,174 @@
+import shlex
+
+import pytest
+
+
+@pytest.fixture
+def rendered():
+    return {
+        'version': '3.4',
+        'services': {
+            'backend': {'image': 'org/img:2', 'ports': ['80:80']},
+            'worker': {'image': 'org/img:1'},
+        },
+    }
+
+
+@pytest.fixture
+def previous():
+    return {
+        'version': '3.4',
+        'services': {
+            'backend': {'image': 'org/img:1', 'ports': ['80:80']},
+            'worker': {'image': 'org/img:1'},
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def render_config(mocker, rendered):
+    return mocker.patch('d.DeployStack.render_config', return_value=rendered)
+
+
+@pytest.fixture(autouse=True)
+def upload_config(mocker):
+    return mocker.patch('d.DeployStack.upload_config')
+
+
+@pytest.fixture(autouse=True)
+def save_deployed_config(mocker):
+    return mocker.patch('d.DeployStack.save_deployed_config')
+
+
+@pytest.fixture(autouse=True)
+def fetch_running_services(mocker, running_spec, previous):
+    return mocker.patch('d.DeployStack.fetch_running_services', return_value=({
+        'mystack_backend': running_spec(),
+        'mystack_worker': running_spec(),
+    }, previous, {'FROM_SHELL': 'shell'}))
+
+
+def call(command, **kwargs):
+    command.handle(config='docker-compose.yml', name='mystack', remainder=[], **kwargs)
+
+
+def commands(run):
+    return [' '.join(c[0][0]) for c in run.call_args_list]
+
+
+def test_only_changed_services_are_updated(command, run):
+    call(command)
+
+    updates = [c for c in commands(run) if 'docker service update' in c]
+
+    assert len(updates) == 1
+    assert '--image org/img:2 mystack_backend' in updates[0]
+
+
+def test_stack_is_not_redeployed(command, run, upload_config, save_deployed_config, rendered):
+    call(command)
+
+    assert not any('docker stack deploy' in c for c in commands(run))
+    upload_config.assert_called_once_with('docker-compose.yml')  # as is, docker stack deploy interpolates it on the manager
+    save_deployed_config.assert_called_once_with(rendered)
+
+
+def test_config_is_rendered_with_the_manager_environment(command, run, render_config):
+    call(command)
+
+    render_config.assert_called_once_with('docker-compose.yml', {'FROM_SHELL': 'shell'})
+
+
+def test_plan_does_not_apply(command, run, upload_config, save_deployed_config):
+    call(command, plan=True)
+
+    assert run.call_count == 0
+    upload_config.assert_not_called()
+    save_deployed_config.assert_not_called()
+
+
+def test_new_services_are_deployed_with_the_stack(command, run, rendered, args_in_call):
+    rendered['services']['frontend'] = {'image': 'org/frontend:1'}
+
+    call(command)
+
+    assert args_in_call(['docker', 'stack', 'deploy', '--prune'], run.call_args[0][0])
+
+
+@pytest.mark.parametrize('change', [
+    lambda config: config['services']['worker'].update(command='./worker.sh'),
+    lambda config: config['services']['backend'].update(ports=['8080:80']),
+    lambda config: config['services']['worker'].update(deploy={'resources': {'limits': {'memory': '1G'}}}),
+    lambda config: config.update(networks={'default': {'driver': 'overlay'}}),
+])
+def test_other_changes_deploy_the_whole_stack(command, run, rendered, args_in_call, change):
+    change(rendered)
+
+    call(command)
+
+    assert args_in_call(['docker', 'stack', 'deploy', '--prune'], run.call_args[0][0])
+    assert not any('docker service update' in c for c in commands(run))
+
+
+def test_no_previous_config_deploys_the_whole_stack(command, run, fetch_running_services, running_spec, args_in_call):
+    fetch_running_services.return_value = ({'mystack_backend': running_spec(), 'mystack_worker': running_spec()}, None, {})
+
+    call(command)
+
+    assert args_in_call(['docker', 'stack', 'deploy', '--prune'], run.call_args[0][0])
+
+
+def test_update_args_are_quoted(command, run, rendered):
+    rendered['services']['backend']['environment'] = {'PRICE': '$5 & more'}
+
+    call(command)
+
+    script = shlex.split(run.call_args[0][0][-1])[0]  # the script is quoted once more for ssh
+
+    assert "--env-add 'PRICE=$5 & more' mystack_backend" in script
+
+
+def test_full(command, run, save_deployed_config, args_in_call):
+    call(command, full=True)
+
+    assert run.call_count == 1
+    assert args_in_call(['docker', 'stack', 'deploy', '--prune'], run.call_args[0][0])
+    save_deployed_config.assert_called_once()
+
+
+def test_env_file_deploys_the_whole_stack(command, run, rendered, running_spec, fetch_running_services, args_in_call):
+    for service in ['backend', 'worker']:
+        rendered['services'][service].update(image='org/img:1', env_file=['.env'], environment=['FROM_SHELL'])
+
+    fetch_running_services.return_value[0].update({
+        'mystack_backend': running_spec(env=['FROM_FILE=file', 'FROM_SHELL=shell']),
+        'mystack_worker': running_spec(env=['FROM_FILE=file', 'FROM_SHELL=shell']),
+    })
+
+    call(command)
+
+    assert commands(run) == ['ssh ==MOCKED_HOST== docker stack deploy --prune -c /srv/mystack/docker-compose.prod.yml mystack']
+
+
+def test_valueless_env_is_not_removed(command, run, rendered, running_spec, fetch_running_services):
+    rendered['services']['worker']['environment'] = ['FROM_SHELL']
+    fetch_running_services.return_value[0]['mystack_worker'] = running_spec(env=['FROM_SHELL=shell'])
+
+    call(command)
+
+    assert not any('--env-rm' in c for c in commands(run))
+
+
+@pytest.mark.parametrize('option', ['--plan', '--full'])
+def test_own_options_after_the_stack_name_are_rejected(command, run, option):
+    with pytest.raises(SystemExit):
+        command.handle(config='docker-compose.yml', name='mystack', remainder=[option])
+
+    run.assert_not_called()
+
+
+def test_remainder_deploys_the_whole_stack(command, run, capsys):
+    command.handle(config='docker-compose.yml', name='mystack', remainder=['--resolve-image', 'never'])
+
+    assert commands(run) == ['ssh ==MOCKED_HOST== docker stack deploy --prune -c /srv/mystack/docker-compose.prod.yml --resolve-image never mystack']
+    assert 'docker stack deploy arguments --resolve-image never' in capsys.readouterr()[0]
@@ -0,0 +1,116 @@
+import pytest
+
+
+@pytest.mark.parametrize('wanted, expected', [
+    [{'image': 'org/img:1', 'environment': ['A=b']}, []],
+    [{'image': 'org/img:2', 'environment': ['A=b']}, [('image', 'org/img:1', 'org/img:2')]],
+    [{'image': 'org/img:1', 'environment': {'A': 'b'}}, []],
+    [{'image': 'org/img:1', 'environment': ['A=c']}, [('env A', 'b', 'c')]],
+    [{'image': 'org/img:1', 'environment': {'A': 'b', 'N': 1}}, [('env N', None, '1')]],
+    [{'image': 'org/img:1'}, [('env A', 'b', None)]],
+    [{'image': 'org/img:1', 'environment': ['A=b'], 'deploy': {'replicas': 3}}, [('replicas', 1, 3)]],
+])
+def test_service_changes(command, running_spec, wanted, expected):
+    assert command.service_changes(wanted, running_spec(env=['A=b'])) == expected
+
+
+def test_registry_port_is_not_a_tag(command, running_spec):
+    running = running_spec(image='registry:5000/org/img:latest', env=['A=b'])
+
+    assert command.service_changes({'image': 'registry:5000/org/img', 'environment': ['A=b']}, running) == []
+
+
+def test_plan(command, running_spec):
+    services = {
+        'backend': {'image': 'org/img:2'},
+        'worker': {'image': 'org/img:1'},
+        'frontend': {'image': 'org/frontend:1'},
+    }
+    running = {
+        'mystack_backend': running_spec(),
+        'mystack_worker': running_spec(),
+        'mystack_old': running_spec(),
+    }
+
+    assert command.get_plan('mystack', services, running) == [
+        ('~', 'mystack_backend', [('image', 'org/img:1', 'org/img:2')]),
+        ('+', 'mystack_frontend', []),
+        ('-', 'mystack_old', []),
+    ]
+
+
+def test_fetching_running_services_is_a_single_query(command, run_output):
+    run_output.return_value = 'HOME=/root\0SHA1=abc\0\0---\n[{"Spec": {"Name": "mystack_backend"}}]\n---\nservices:\n  backend:\n    image: org/img:1\n'.encode()
+
+    running, previous, env = command.fetch_running_services('mystack')
+
+    assert running == {'mystack_backend': {'Name': 'mystack_backend'}}
+    assert previous == {'services': {'backend': {'image': 'org/img:1'}}}
+    assert env == {'HOME': '/root', 'SHA1': 'abc'}
+    assert run_output.call_count == 1
+    assert run_output.call_args[0][0][:4] == ['ssh', '==MOCKED_HOST==', 'sh', '-c']
+    assert '/srv/mystack/deployed-config.yml' in run_output.call_args[0][0][-1]
+
+
+def test_no_previous_config(command, run_output):
+    run_output.return_value = '\0---\n[]\n---\n'.encode()
+
+    assert command.fetch_running_services('mystack') == ({}, None, {})
+
+
+def test_fetching_running_services_on_localhost(command, run_output):
+    command.host.name = 'localhost'
+    run_output.return_value = '\0---\n[]\n---\n'.encode()
+
+    command.fetch_running_services('mystack')
+
+    assert run_output.call_args[0][0][:2] == ['sh', '-c']
+
+
+def test_config_is_interpolated_with_the_manager_environment(command, tmpdir, monkeypatch):
+    monkeypatch.setenv('SHA1', 'local')
+    config = tmpdir.join('docker-compose.yml')
+    config.write('services:\n  backend:\n    image: org/img:${SHA1}\n')
+
+    assert command.render_config(str(config), {'SHA1': 'manager'}) == {'services': {'backend': {'image': 'org/img:manager'}}}
+
+
+@pytest.mark.parametrize('env, expected', [
+    [{'A': True, 'B': False}, {'A': 'true', 'B': 'false'}],
+    [{'A': 1, 'B': None}, {'A': '1'}],
+    [['A=b=c', 'B'], {'A': 'b=c'}],
+    [['A=b', 'FROM_SHELL', 'MISSING'], {'A': 'b', 'FROM_SHELL': 'shell'}],
+    [{'A': 'b', 'FROM_SHELL': None}, {'A': 'b', 'FROM_SHELL': 'shell'}],
+])
+def test_normalize_env(command, env, expected):
+    assert command.normalize_env(env, {'FROM_SHELL': 'shell'}) == expected
+
+
+def test_valueless_env_is_taken_from_the_manager_environment(command, running_spec):
+    wanted = {'image': 'org/img:1', 'environment': ['FROM_SHELL', 'A=b']}
+
+    assert command.service_changes(wanted, running_spec(env=['A=b', 'FROM_SHELL=shell']), {'FROM_SHELL': 'shell'}) == []
+    assert command.service_changes(wanted, running_spec(env=['A=b', 'FROM_SHELL=old']), {'FROM_SHELL': 'shell'}) == [('env FROM_SHELL', 'old', 'shell')]
+
+
+def test_env_file_variables_are_not_removed(command, running_spec):
+    wanted = {'image': 'org/img:1', 'env_file': ['.env'], 'environment': ['FROM_SHELL', 'A=b']}
+
+    assert command.service_changes(wanted, running_spec(env=['A=b', 'FROM_FILE=file', 'FROM_SHELL=shell']), {'FROM_SHELL': 'shell'}) == []
+
+
+def test_env_file_deploys_the_whole_stack(command):
+    previous = {'services': {'backend': {'image': 'org/img:1', 'env_file': ['.env']}}}
+
+    assert command.other_changes(previous, {'services': {'backend': {'image': 'org/img:2', 'env_file': ['.env']}}}) == ['service backend env_file']
+
+
+def test_other_changes(command):
+    previous = {'services': {'backend': {'image': 'org/img:1', 'environment': ['A=b'], 'deploy': {'replicas': 1, 'mode': 'replicated'}}}}
+    rendered = {'services': {'backend': {'image': 'org/img:2', 'environment': ['A=c'], 'deploy': {'replicas': 3, 'mode': 'replicated'}}}}
+
+    assert command.other_changes(previous, rendered) == []
+
+    rendered['services']['backend']['deploy']['mode'] = 'global'
+
+    assert command.other_changes(previous, rendered) == ['service backend']
@@ -0,0 +1,49 @@
+import io
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def get_services(mocker):
+    return mocker.patch('d.Logs.get_services', return_value=['mystack_backend', 'mystack_worker'])
+
+
+@pytest.fixture(autouse=True)
+def process(mocker):
+    process = mocker.patch('d.Host.stream').return_value
+    process.stdout = io.BytesIO(b'mystack_backend.1@node1 | started\nmystack_worker.1@node2 | started\n')
+    process.wait.return_value = 0
+
+    return process
+
+
+def test_output(command, capsys):
+    command.handle(name='mystack')
+
+    out = capsys.readouterr()[0]
+
+    assert 'mystack_backend.1@node1 | started' in out
+    assert 'mystack_worker.1@node2 | started' in out
+
+
+def test_image_filter(command, get_services):
+    command.handle(name='mystack', image='org/img')
+
+    get_services.assert_called_once_with('mystack', 'org/img')
+
+
+def test_no_services(command, get_services):
+    get_services.return_value = []
+
+    with pytest.raises(SystemExit):
+        command.handle(name='mystack')
+
+
+def test_failure_exit_code(command, process, capsys):
+    process.wait.return_value = 255
+
+    with pytest.raises(SystemExit) as e:
+        command.handle(name='mystack')
+
+    assert e.value.code == 255
+    assert 'Streaming logs failed with exit code 255' in capsys.readouterr()[0]
@@ -0,0 +1,20 @@
+import pytest
+
+
+def test_single_connection_for_all_services(command):
+    script = command.logs_script(['stack_backend', 'stack_worker'])
+
+    assert 'docker service logs --tail 100 stack_backend 2>&1 & pid0=$!;' in script
+    assert 'docker service logs --tail 100 stack_worker 2>&1 & pid1=$!;' in script
+    assert 'wait $pid0 || failed=1; wait $pid1 || failed=1;' in script
+    assert script.endswith('exit $failed')
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    [dict(follow=True), '--tail 100 --follow stack_backend'],
+    [dict(since='42m'), '--tail 100 --since 42m stack_backend'],
+    [dict(tail='all'), '--tail all stack_backend'],
+    [dict(tail=5, since='2018-01-01 00:00'), "--tail 5 --since '2018-01-01 00:00' stack_backend"],
+])
+def test_args(command, kwargs, expected):
+    assert expected in command.logs_script(['stack_backend'], **kwargs)
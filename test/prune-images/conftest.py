@@ -0,0 +1,15 @@
+import pytest
+from d import PruneImages
+
+
+@pytest.fixture
+def command(mock_command):
+    return mock_command(PruneImages)
+
+
+@pytest.fixture
+def image():
+    def _image(created, tags, size=100):
+        return dict(id='sha256:' + created, size=size, created=created, tags=tags)
+
+    return _image
@@ -0,0 +1,36 @@
+import shlex
+
+NODE = {'ID': 'n1-id'}
+
+
+def test_images_are_fetched_through_a_one_off_service(command, run_output):
+    run_output.return_value = b'sha256:a|150|2018-01-01|["org/img:latest"]|["l1","l2"]|50 0 100 \n'
+
+    assert command.fetch_images(NODE, 'docker:cli') == [
+        dict(id='sha256:a', size=150, created='2018-01-01', tags=['org/img:latest'], layers={'l1': 100, 'l2': 50}),
+    ]
+
+    script = shlex.split(run_output.call_args[0][0][-1])[0]  # the script is quoted once more for ssh
+    assert run_output.call_args[0][0][:2] == ['ssh', '==MOCKED_HOST==']
+    assert '--constraint node.id==n1-id --mount type=bind,source=/var/run/docker.sock,target=/var/run/docker.sock docker:cli sh -c' in script
+    assert 'docker image ls -q --no-trunc | sort -u' in script
+
+
+def test_image_with_many_tags_is_listed_once(command, run_output):
+    run_output.return_value = b'\n'.join([
+        b'sha256:a|100|2018-01-02|["org/img:1111111111111111111111111111111111111111","org/img:latest"]|["l1"]|100',
+        b'sha256:a|100|2018-01-02|["org/img:1111111111111111111111111111111111111111","org/img:latest"]|["l1"]|100',
+        b'sha256:b|100|2018-01-01|["org/img:2222222222222222222222222222222222222222"]|["l2"]|100',
+        b'',
+    ])
+
+    images = command.fetch_images(NODE, 'docker:cli')
+
+    assert sorted(image['id'] for image in images) == ['sha256:a', 'sha256:b']
+    assert command.select(images, used=set(), keep=2) == ([], 0)
+
+
+def test_untagged_image(command, run_output):
+    run_output.return_value = b'sha256:a|100|2018-01-02|null|["l1"]|100\n'
+
+    assert command.fetch_images(NODE, 'docker:cli')[0]['tags'] == []
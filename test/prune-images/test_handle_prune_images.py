@@ -0,0 +1,87 @@
+import shlex
+import subprocess
+
+import pytest
+
+SHA1 = ['{}'.format(i) * 40 for i in range(1, 4)]
+
+
+def node(hostname, state='ready', availability='active'):
+    return {
+        'ID': hostname + '-id',
+        'Spec': {'Availability': availability},
+        'Status': {'State': state},
+        'Description': {'Hostname': hostname},
+    }
+
+
+@pytest.fixture(autouse=True)
+def fetch_nodes(mocker):
+    return mocker.patch('d.PruneImages.fetch_nodes', return_value=([
+        node('n1'),
+        node('n2'),
+        node('n3', state='down'),
+        node('n4', availability='drain'),
+    ], {}))
+
+
+@pytest.fixture(autouse=True)
+def fetch_used_images(mocker):
+    return mocker.patch('d.PruneImages.fetch_used_images', return_value=set())
+
+
+@pytest.fixture(autouse=True)
+def fetch_images(mocker, image):
+    return mocker.patch('d.PruneImages.fetch_images', return_value=[
+        image('2018-01-01', ['org/img:' + SHA1[0]]),
+        image('2018-01-02', ['org/img:' + SHA1[1]]),
+        image('2018-01-03', ['org/img:' + SHA1[2]]),
+    ])
+
+
+def scripts(run):
+    return [shlex.split(c[0][0][-1])[0] for c in run.call_args_list]  # the script is quoted once more for ssh
+
+
+def test_every_active_node_is_pruned_through_the_manager(command, run):
+    command.handle(keep=2)
+
+    assert run.call_count == 2
+    assert all(c[0][0][0] == 'ssh' and '==MOCKED_HOST==' in c[0][0] for c in run.call_args_list)
+    assert sorted('node.id==n1-id' in script for script in scripts(run)) == [False, True]
+    assert all("docker:cli sh -c 'docker image rm org/img:{}'".format(SHA1[0]) in script for script in scripts(run))
+
+
+def test_docker_image(command, run):
+    command.handle(keep=2, docker_image='docker:20.10')
+
+    assert all('docker:20.10 sh -c' in script for script in scripts(run))
+
+
+def test_dry_run(command, run, capsys):
+    command.handle(keep=2, dry_run=True)
+
+    assert run.call_count == 0
+    assert 'n1 would remove 1 tags, freeing up to 100.0 B' in capsys.readouterr()[0]
+
+
+def test_nothing_to_remove(command, run):
+    command.handle(keep=5)
+
+    assert run.call_count == 0
+
+
+def test_failed_node_fails_the_command(command, run, fetch_images, capsys):
+    def images(node, docker_image):
+        if node['ID'] == 'n2-id':
+            raise subprocess.CalledProcessError(1, 'ssh')
+
+        return []
+
+    fetch_images.side_effect = images
+
+    with pytest.raises(SystemExit) as e:
+        command.handle(keep=2)
+
+    assert e.value.code == 1
+    assert 'n2 failed:' in capsys.readouterr()[0]
@@ -0,0 +1,85 @@
+import pytest
+
+SHA1 = ['{}'.format(i) * 40 for i in range(1, 5)]
+
+
+@pytest.fixture
+def images(image):
+    return [
+        image('2018-01-01', ['org/img:' + SHA1[0]]),
+        image('2018-01-02', ['org/img:' + SHA1[1]]),
+        image('2018-01-03', ['org/img:' + SHA1[2]]),
+        image('2018-01-04', ['org/img:' + SHA1[3], 'org/img:latest']),
+        image('2018-01-05', ['org/other:201801051530']),
+        image('2018-01-06', ['org/other:201801061530']),
+        image('2018-01-07', ['org/custom:stable']),
+    ]
+
+
+def test_keep_latest_tags(command, images):
+    tags, freed = command.select(images, used=set(), keep=1)
+
+    assert tags == ['org/img:' + SHA1[0], 'org/img:' + SHA1[1], 'org/img:' + SHA1[2], 'org/other:201801051530']
+    assert freed == 400
+
+
+def test_used_tags_are_kept(command, images):
+    tags, _ = command.select(images, used={'org/img:' + SHA1[0]}, keep=1)
+
+    assert 'org/img:' + SHA1[0] not in tags
+
+
+def test_image_name_filter(command, images):
+    tags, _ = command.select(images, used=set(), keep=1, names=['org/other'])
+
+    assert tags == ['org/other:201801051530']
+
+
+def test_image_is_not_freed_while_it_has_other_tags(command, image):
+    images = [
+        image('2018-01-01', ['org/img:' + SHA1[0], 'org/img:stable']),
+        image('2018-01-02', ['org/img:' + SHA1[1]]),
+    ]
+
+    tags, freed = command.select(images, used=set(), keep=1)
+
+    assert tags == ['org/img:' + SHA1[0]]
+    assert freed == 0
+
+
+def test_layers_of_kept_images_are_not_freed(command):
+    images = [
+        dict(id='sha256:a', size=150, created='2018-01-01', tags=['org/img:' + SHA1[0]], layers={'base': 100, 'a': 50}),
+        dict(id='sha256:b', size=160, created='2018-01-02', tags=['org/img:' + SHA1[1]], layers={'base': 100, 'b': 60}),
+        dict(id='sha256:c', size=170, created='2018-01-03', tags=['org/img:' + SHA1[2]], layers={'base': 100, 'c': 70}),
+    ]
+
+    assert command.select(images, used=set(), keep=1) == (['org/img:' + SHA1[0], 'org/img:' + SHA1[1]], 110)
+    assert command.select(images, used=set(), keep=0) == (sorted('org/img:' + sha1 for sha1 in SHA1[:3]), 280)  # the base layer once
+
+
+def test_layers_of_untagged_images_are_not_freed(command):
+    images = [
+        dict(id='sha256:a', size=150, created='2018-01-01', tags=['org/img:' + SHA1[0]], layers={'base': 100, 'a': 50}),
+        dict(id='sha256:b', size=100, created='2018-01-02', tags=[], layers={'base': 100}),
+    ]
+
+    assert command.select(images, used=set(), keep=0) == (['org/img:' + SHA1[0]], 50)
+
+
+@pytest.mark.parametrize('layers, history, expected', [
+    [['l1', 'l2'], [60, 0, 100], {'l1': 100, 'l2': 60}],
+    [['l1', 'l2', 'l3'], [60, 0, 100], {'l1': 100, 'l2': 60, 'l3': 0}],
+    [['l1'], [], {'l1': 0}],
+])
+def test_layer_sizes(command, layers, history, expected):
+    assert command.layer_sizes(layers, history) == expected
+
+
+@pytest.mark.parametrize('size, expected', [
+    [100, '100.0 B'],
+    [2048, '2.0 KB'],
+    [3 * 1024 ** 3, '3.0 GB'],
+])
+def test_human_size(command, size, expected):
+    assert command.human_size(size) == expected
@@ -0,0 +1,7 @@
+import pytest
+from d import Rollback
+
+
+@pytest.fixture
+def command(mock_command):
+    return mock_command(Rollback)
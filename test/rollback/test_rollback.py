@@ -0,0 +1,77 @@
+import json
+
+import pytest
+from d import quote
+
+
+@pytest.fixture
+def snapshot():
+    return {
+        'stack': 'mystack',
+        'image': 'org/img:v2@sha256:new',
+        'created': '2018-10-01T15:30:00',
+        'services': {
+            'mystack_backend': 'org/img:v1@sha256:old',
+            'mystack_worker': 'org/img:v1@sha256:old',
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(monkeypatch, tmpdir):
+    monkeypatch.setenv('SNAPSHOT_DIR', str(tmpdir))
+    return tmpdir
+
+
+def test_snapshot_from_the_manager(command, snapshot, run_output, monkeypatch):
+    monkeypatch.setenv('STACK_DIR', '/srv')
+    run_output.return_value = json.dumps(snapshot).encode()
+
+    assert command.load_snapshot('mystack') == snapshot
+    run_output.assert_called_once_with(['ssh', '==MOCKED_HOST==', 'sh', '-c', quote('cat /srv/mystack/image-snapshot.json 2>/dev/null; true')])
+
+
+def test_manager_snapshot_wins_over_the_local_one(command, snapshot, snapshot_dir, run_output):
+    snapshot_dir.join('mystack.json').write(json.dumps(dict(snapshot, created='2018-09-01T15:30:00')))
+    run_output.return_value = json.dumps(snapshot).encode()
+
+    assert command.load_snapshot('mystack')['created'] == '2018-10-01T15:30:00'
+
+
+def test_local_snapshot_when_the_manager_has_none(command, snapshot, snapshot_dir, run_output):
+    snapshot_dir.join('mystack.json').write(json.dumps(snapshot))
+    run_output.return_value = b''
+
+    assert command.load_snapshot('mystack') == snapshot
+
+
+def test_no_snapshot(command, run, run_output, capsys):
+    run_output.return_value = b''
+
+    with pytest.raises(SystemExit):
+        command.handle(name='mystack', remainder=[])
+
+    run.assert_not_called()
+    assert 'No image snapshot found for stack mystack' in capsys.readouterr()[0]
+
+
+def test_script(command, snapshot):
+    script = command.rollback_script(snapshot['services'])
+
+    assert 'docker service update --with-registry-auth --no-resolve-image --image org/img:v1@sha256:old mystack_backend >/dev/null & pid0=$!' in script
+    assert 'docker service update --with-registry-auth --no-resolve-image --image org/img:v1@sha256:old mystack_worker >/dev/null & pid1=$!' in script
+    assert 'wait $pid1 && echo mystack_worker restored || { echo mystack_worker failed; failed=1; }' in script
+    assert script.endswith('exit $failed')
+
+
+def test_remainder(command, snapshot):
+    assert '--update-parallelism 0 mystack_backend' in command.rollback_script(snapshot['services'], ['--update-parallelism', 0])
+
+
+def test_all_services_are_restored_in_a_single_connection(command, snapshot, mocker, run):
+    mocker.patch('d.Rollback.load_snapshot', return_value=snapshot)
+
+    command.handle(name='mystack', remainder=[])
+
+    assert run.call_count == 1
+    assert run.call_args[0][0][:4] == ['ssh', '==MOCKED_HOST==', 'sh', '-c']
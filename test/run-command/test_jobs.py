@@ -0,0 +1,92 @@
+import io
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def get_env(mocker):
+    return mocker.patch('d.RunCommand.get_env', return_value=dict(a='b'))
+
+
+@pytest.fixture(autouse=True)
+def stream(mocker):
+    def _process(script):
+        process = mocker.Mock()
+        process.stdout = io.BytesIO(b'done\r\n')
+        process.wait.return_value = 1 if 'failing' in script else 0
+        return process
+
+    return mocker.patch('d.Host.stream', side_effect=_process)
+
+
+@pytest.fixture
+def jobs(tmpdir):
+    jobs = tmpdir.join('jobs.txt')
+    jobs.write('--tenant acme\n\n# comment\n--tenant initech\n')
+    return str(jobs)
+
+
+def call(command, jobs, **kwargs):
+    command.handle(env_from='test', image='org/img:latest', command='./manage.py report', remainder=['--noinput'], jobs=jobs, **kwargs)
+
+
+def test_read_jobs(command, jobs):
+    assert command.read_jobs(jobs) == ['--tenant acme', '--tenant initech']
+
+
+def test_every_job_is_run(command, jobs, stream):
+    call(command, jobs)
+
+    scripts = sorted(c[0][0] for c in stream.call_args_list)
+
+    assert scripts == [
+        'docker run -ea=b org/img:latest ./manage.py report --noinput --tenant acme',
+        'docker run -ea=b org/img:latest ./manage.py report --noinput --tenant initech',
+    ]
+
+
+def test_env_is_fetched_once(command, jobs, get_env):
+    call(command, jobs)
+
+    get_env.assert_called_once_with('test')
+
+
+def test_output_is_prefixed(command, jobs, capsys):
+    call(command, jobs)
+
+    out = capsys.readouterr()[0]
+
+    assert '[--tenant acme] done\n' in out
+    assert '[--tenant initech] done\n' in out
+    assert '2 jobs succeeded, 0 failed' in out
+
+
+def test_connection_is_shared(command, jobs):
+    call(command, jobs)
+
+    assert 'ControlMaster=auto' in command.host.ssh
+
+
+def test_failure(command, tmpdir, capsys):
+    jobs = tmpdir.join('jobs.txt')
+    jobs.write('--tenant acme\n--tenant failing\n')
+
+    with pytest.raises(SystemExit):
+        call(command, str(jobs))
+
+    assert '1 jobs succeeded, 1 failed' in capsys.readouterr()[0]
+
+
+def test_metrics(command, jobs):
+    call(command, jobs)
+
+    assert sorted(m[1]['job'] for m in command.metrics.measurements) == ['--tenant acme', '--tenant initech']
+
+
+def test_jobs_on_a_node(command, jobs, stream, mocker):
+    mocker.patch('d.RunCommand.get_target_node', return_value={'ID': 'w1-id', 'Description': {'Hostname': 'w1'}})
+
+    call(command, jobs, node='auto')
+
+    assert all('--constraint node.id==w1-id' in c[0][0] for c in stream.call_args_list)
+    assert sorted(m[1]['host'] for m in command.metrics.measurements) == ['w1', 'w1']
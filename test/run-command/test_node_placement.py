@@ -0,0 +1,104 @@
+import pytest
+
+
+def node(hostname, cpus=2, memory_gb=4, role='worker', state='ready', availability='active'):
+    return {
+        'ID': hostname + '-id',
+        'Spec': {'Role': role, 'Availability': availability},
+        'Status': {'State': state, 'Addr': hostname + '.addr'},
+        'Description': {
+            'Hostname': hostname,
+            'Resources': {'NanoCPUs': cpus * 10 ** 9, 'MemoryBytes': memory_gb * 1024 ** 3},
+        },
+    }
+
+
+def tasks(count, cpus=0, memory_gb=0):
+    return dict(tasks=count, cpus=cpus * 10 ** 9, memory=memory_gb * 1024 ** 3)
+
+
+@pytest.mark.parametrize('nodes, running, expected', [
+    [[node('w1'), node('w2')], {'w1-id': tasks(3), 'w2-id': tasks(1)}, 'w2'],
+    [[node('w1', cpus=8, memory_gb=16), node('w2')], {'w1-id': tasks(3), 'w2-id': tasks(1)}, 'w1'],
+    [[node('w1'), node('w2')], {}, 'w1'],
+    [[node('m1', cpus=32, role='manager'), node('w1')], {}, 'w1'],
+    [[node('m1', role='manager'), node('w1', state='down')], {}, 'm1'],
+    [[node('w1', availability='drain'), node('w2')], {'w2-id': tasks(10)}, 'w2'],
+    [[node('w1', cpus=8, memory_gb=16), node('w2')], {'w1-id': tasks(1, cpus=7, memory_gb=15)}, 'w2'],  # most of w1 is reserved
+])
+def test_choose_node(command, nodes, running, expected):
+    assert command.choose_node(nodes, running)['Description']['Hostname'] == expected
+
+
+def test_node_load(command):
+    assert command.node_load(node('w1', cpus=4, memory_gb=8), {'w1-id': tasks(2, cpus=1, memory_gb=2)}) == (3, 6 * 1024 ** 3, 2)
+
+
+def test_no_nodes(command):
+    with pytest.raises(AssertionError):
+        command.choose_node([node('w1', state='down')], {})
+
+
+def test_fetch_nodes_is_a_single_query(command, run_output):
+    run_output.return_value = '\n'.join([
+        '[{"ID": "w1-id"}]',
+        '---',
+        'w1-id|{"Reservations": {"NanoCPUs": 500000000, "MemoryBytes": 1024}}',
+        'w1-id|null',
+        'w2-id|{"Limits": {"MemoryBytes": 1024}}',
+        '',
+    ]).encode()
+
+    nodes, running = command.fetch_nodes()
+
+    assert nodes == [{'ID': 'w1-id'}]
+    assert running == {
+        'w1-id': dict(tasks=2, cpus=500000000, memory=1024),
+        'w2-id': dict(tasks=1, cpus=0, memory=0),
+    }
+    assert run_output.call_count == 1
+
+
+@pytest.mark.parametrize('requested, expected', [
+    ['auto', 'w2-id'],
+    ['w1', 'w1-id'],
+    ['w1-id', 'w1-id'],
+])
+def test_command_runs_on_the_chosen_node_through_the_manager(command, run, mocker, requested, expected):
+    mocker.patch('d.RunCommand.fetch_nodes', return_value=([node('w1'), node('w2')], {'w1-id': tasks(5)}))
+
+    command.handle(env_from='', image='org/img:latest', command='./manage.py migrate', remainder=[], node=requested)
+
+    assert run.call_count == 1
+    assert run.call_args[0][0][:4] == ['ssh', '==MOCKED_HOST==', 'sh', '-c']
+    assert 'node.id=={}'.format(expected) in run.call_args[0][0][-1]
+
+
+def test_job_script(command):
+    script = command.job_script([['-ea=b'], 'org/img:latest', './manage.py migrate', ['--noinput']], node=node('w1'))
+
+    assert script.startswith(
+        'service=$(docker service create --detach --quiet --with-registry-auth --restart-condition none --constraint node.id==w1-id '
+        '-ea=b org/img:latest ./manage.py migrate --noinput) || exit 1',
+    )
+    assert 'trap \'docker service rm "$service" >/dev/null\' EXIT' in script.split('\n')[1]  # removed when ssh is interrupted too
+    assert script.endswith('exit ${code:-1}')
+
+
+def test_job_script_without_node(command):
+    assert command.job_script([['-ea=b'], 'org/img:latest', './manage.py migrate']) == 'docker run -ea=b org/img:latest ./manage.py migrate'
+
+
+def test_fetch_nodes_on_localhost(command, run_output):
+    command.host.name = 'localhost'
+    run_output.return_value = '[]\n---\n'.encode()
+
+    assert command.fetch_nodes() == ([], {})
+    assert run_output.call_args[0][0][:2] == ['sh', '-c']
+
+
+def test_unknown_node(command, run, mocker):
+    mocker.patch('d.RunCommand.fetch_nodes', return_value=([node('w1')], {}))
+
+    with pytest.raises(AssertionError):
+        command.handle(env_from='', image='org/img:latest', command='./manage.py migrate', remainder=[], node='w3')
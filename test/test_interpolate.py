@@ -0,0 +1,24 @@
+import pytest
+from d import interpolate
+
+ENV = {'SHA1': 'abc', 'EMPTY': ''}
+
+
+@pytest.mark.parametrize('value, expected', [
+    ['org/img:${SHA1}', 'org/img:abc'],
+    ['org/img:$SHA1', 'org/img:abc'],
+    ['org/img:${MISSING}', 'org/img:'],
+    ['${MISSING:-latest}', 'latest'],
+    ['${EMPTY:-latest}', 'latest'],
+    ['${EMPTY-latest}', ''],
+    ['${MISSING-latest}', 'latest'],
+    ['price $$5', 'price $5'],
+    [{'image': 'org/img:${SHA1}', 'ports': ['80:80', 8080], 'debug': True}, {'image': 'org/img:abc', 'ports': ['80:80', 8080], 'debug': True}],
+])
+def test(value, expected):
+    assert interpolate(value, ENV) == expected
+
+
+def test_required():
+    with pytest.raises(AssertionError):
+        interpolate('${MISSING:?set it}', ENV)
@@ -0,0 +1,24 @@
+import pytest
+from d import LineBuffer
+
+
+@pytest.fixture
+def buffer():
+    return LineBuffer(size=3)
+
+
+def test(buffer):
+    buffer.put('a')
+    buffer.put('b')
+    buffer.close()
+
+    assert list(buffer) == ['a', 'b']
+
+
+def test_oldest_lines_are_dropped(buffer):
+    for line in 'abcde':
+        buffer.put(line)
+
+    buffer.close()
+
+    assert list(buffer) == ['... 2 lines dropped ...', 'c', 'd', 'e']
@@ -0,0 +1,91 @@
+import pytest
+from d import Host, Metrics
+
+
+@pytest.fixture
+def host():
+    host = Host('manager')
+    host.round_trips = 3
+    host.bytes_sent = 100
+    host.bytes_received = 42
+    return host
+
+
+@pytest.fixture
+def metrics(host):
+    return Metrics('update-image', hosts=[host, Host('localhost')])
+
+
+def test_measure(metrics):
+    with metrics.measure('service_update', service='mystack_backend'):
+        pass
+
+    with pytest.raises(SystemExit):
+        with metrics.measure('service_update', service='mystack_worker'):
+            exit(127)
+
+    assert [(m[1]['service'], m[3]) for m in metrics.measurements] == [('mystack_backend', True), ('mystack_worker', False)]
+
+
+def test_render(metrics, mocker):
+    mocker.patch('d.time.time', return_value=100)
+    with metrics.measure('service_update', service='mystack_backend'):
+        pass
+
+    rendered = metrics.render()
+
+    assert '# TYPE d_service_update_duration_seconds gauge' in rendered
+    assert 'd_service_update_duration_seconds{command="update-image",result="success",service="mystack_backend"} 0.000' in rendered
+    assert 'd_service_updates{command="update-image",result="success"} 1' in rendered
+    assert 'd_service_updates{command="update-image",result="failure"} 0' in rendered
+    assert 'd_ssh_round_trips{command="update-image",host="manager"} 3' in rendered
+    assert 'd_ssh_sent_bytes{command="update-image",host="manager"} 100' in rendered
+    assert 'd_ssh_received_bytes{command="update-image",host="manager"} 42' in rendered
+    assert 'd_last_run_timestamp_seconds{command="update-image"} 100' in rendered
+    assert 'host="localhost"' not in rendered
+    assert rendered.endswith('# EOF\n')
+
+
+def test_label_escaping(metrics):
+    assert metrics.sample('d_test', {'a': 'say "hi"\n'}, 1) == 'd_test{a="say \\"hi\\"\\n"} 1'
+
+
+def test_write(metrics, tmpdir):
+    filename = str(tmpdir.join('d.prom'))
+
+    metrics.write(filename)
+
+    assert open(filename).read() == metrics.render()
+    assert tmpdir.listdir() == [tmpdir.join('d.prom')]
+
+
+def test_host_counters(run_output):
+    run_output.return_value = 'output'.encode()
+    host = Host('manager')
+
+    host.get_output('echo', 'output')
+
+    assert host.round_trips == 1
+    assert host.bytes_received == 6
+
+
+def test_metrics_of_other_commands_are_kept(metrics, host, tmpdir, mocker):
+    mocker.patch('d.time.time', return_value=100)
+    filename = str(tmpdir.join('d.prom'))
+    deploy = Metrics('deploy-stack', hosts=[host])
+    with deploy.measure('service_update', service='mystack_backend'):
+        pass
+
+    deploy.write(filename)
+    metrics.write(filename)
+    metrics.write(filename)  # the same command replaces its own samples
+
+    written = open(filename).read()
+
+    assert written.count('d_ssh_round_trips{command="deploy-stack",host="manager"} 3') == 1
+    assert written.count('d_ssh_round_trips{command="update-image",host="manager"} 3') == 1
+    assert written.count('d_last_run_timestamp_seconds{command="update-image"} 100') == 1
+    assert 'd_service_update_duration_seconds{command="deploy-stack",result="success",service="mystack_backend"} 0.000' in written
+    assert written.count('# TYPE d_ssh_round_trips gauge') == 1
+    assert written.index('d_ssh_round_trips{command="deploy-stack"') < written.index('d_ssh_round_trips{command="update-image"') < written.index('# HELP d_ssh_sent_bytes')
+    assert written.endswith('# EOF\n')
@@ -66,3 +66,11 @@ def test_scp(host, run, hostname, call):
     host.cp('src', 'dst')
 
     run.assert_called_once_with(*call)
+
+
+def test_shared_connection(run):
+    host = Host('manager')
+    host.control_path = '/tmp/d-ssh-%C'
+    host.run('echo test')
+
+    run.assert_called_once_with('ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/d-ssh-%C', '-o', 'ControlPersist=60', 'manager', 'echo test')
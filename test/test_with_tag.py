@@ -0,0 +1,13 @@
+import pytest
+from d import with_tag
+
+
+@pytest.mark.parametrize('image, expected', [
+    ['org/img', 'org/img:latest'],
+    ['org/img:1', 'org/img:1'],
+    ['org/img:1@sha256:abcdef', 'org/img:1'],
+    ['registry:5000/org/img', 'registry:5000/org/img:latest'],
+    ['registry:5000/org/img:1@sha256:abcdef', 'registry:5000/org/img:1'],
+])
+def test(image, expected):
+    assert with_tag(image) == expected
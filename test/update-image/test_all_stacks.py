@@ -0,0 +1,86 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def fetch_all_services(mocker):
+    return mocker.patch('d.UpdateImage.fetch_all_services', return_value=[
+        ['stack1', 'stack1_worker', 'org/img:v1@sha256:old'],
+        ['stack1', 'stack1_backend', 'org/backend:v1@sha256:other'],
+        ['stack2', 'stack2_worker', 'org/img:v1@sha256:old'],
+        ['stack2', 'stack2_beat', 'org/img:v1'],
+        ['', 'standalone', 'org/img:v1'],
+    ])
+
+
+@pytest.fixture(autouse=True)
+def find_digest(mocker):
+    return mocker.patch('d.UpdateImage.find_digest', return_value='sha256:new')
+
+
+@pytest.fixture(autouse=True)
+def save_snapshot(mocker):
+    return mocker.patch('d.UpdateImage.save_snapshot')
+
+
+def call(command, **kwargs):
+    command.handle(name='org/img:v2', image=None, remainder=[], **kwargs)
+
+
+def test_get_stacks(command):
+    stacks, images = command.get_stacks('org/img:v2')
+
+    assert stacks == {
+        'stack1': ['stack1_worker'],
+        'stack2': ['stack2_beat', 'stack2_worker'],
+    }
+    assert images['stack2_beat'] == 'org/img:v1'
+
+
+def test_all_stacks(command, run, fetch_all_services):
+    call(command, all_stacks=True)
+
+    assert [c[0][0][-1] for c in run.call_args_list] == ['stack1_worker', 'stack2_beat', 'stack2_worker']
+    fetch_all_services.assert_called_once_with(None)
+
+
+def test_label(command, run, fetch_all_services):
+    call(command, label='com.example.role=worker')
+
+    fetch_all_services.assert_called_once_with('com.example.role=worker')
+
+
+def test_snapshot_per_stack(command, run, save_snapshot):
+    call(command, all_stacks=True)
+
+    save_snapshot.assert_any_call('stack1', 'org/img:v2@sha256:new', ['stack1_worker'], images={'stack1_worker': 'org/img:v1@sha256:old'})
+    assert save_snapshot.call_count == 2
+
+
+def test_output_is_grouped_by_stack(command, run, capsys):
+    call(command, all_stacks=True)
+
+    out = capsys.readouterr()[0]
+
+    assert out.index('Stack stack1') < out.index('Updating stack1_worker') < out.index('Stack stack2') < out.index('Updating stack2_beat')
+    assert 'Updated 3 services in 2 stacks' in out
+
+
+def test_stack_name_is_rejected(command):
+    with pytest.raises(SystemExit):
+        command.handle(name='mystack', image='org/img:v2', remainder=[], all_stacks=True)
+
+
+def test_label_with_stack_name_is_rejected(command):
+    with pytest.raises(SystemExit):
+        command.handle(name='mystack', image='org/img:v2', remainder=[], label='com.example.role=worker')
+
+
+def test_registry_port_is_not_a_tag(command, fetch_all_services):
+    fetch_all_services.return_value = [
+        ['stack1', 'stack1_worker', 'registry:5000/org/img:v1@sha256:old'],
+        ['stack1', 'stack1_other', 'registry:5000/org/other:v1'],
+    ]
+
+    stacks, _ = command.get_stacks('registry:5000/org/img:v2')
+
+    assert stacks == {'stack1': ['stack1_worker']}
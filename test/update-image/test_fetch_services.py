@@ -32,3 +32,35 @@ def test_filtering(command, mocker, output, expected):
     mocker.patch.object(command, 'fetch_services', return_value=output)
 
     assert list(command.get_services('mystack', 'org/img')) == expected
+
+
+def test_no_image_filter(command, mocker):
+    mocker.patch.object(command, 'fetch_services', return_value=[['backend', 'org/img'], ['frontend', 'org/frontend_img']])
+
+    assert list(command.get_services('mystack')) == ['backend', 'frontend']
+
+
+def test_fetch_all_services(command, run_output):
+    run_output.return_value = "stack1|stack1_worker|org/img:v1@sha256:old\n|standalone|org/img".encode()
+
+    assert command.fetch_all_services() == [
+        ['stack1', 'stack1_worker', 'org/img:v1@sha256:old'],
+        ['', 'standalone', 'org/img'],
+    ]
+    assert run_output.call_count == 1
+
+
+def test_fetch_all_services_by_label(command, run_output):
+    run_output.return_value = b''
+
+    command.fetch_all_services('com.example.role=worker')
+
+    assert 'docker service inspect $(docker service ls -q --filter label=com.example.role=worker)' in run_output.call_args[0][0][-1]
+
+
+def test_fetch_all_services_on_localhost(command, run_output):
+    command.host.name = 'localhost'
+    run_output.return_value = b''
+
+    assert command.fetch_all_services() == []
+    assert run_output.call_args[0][0][:2] == ['sh', '-c']
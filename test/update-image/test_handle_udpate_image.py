@@ -8,6 +8,16 @@ def get_services(mocker):
     return mocker.patch('d.UpdateImage.get_services', return_value=['backend', 'frontend'])
 
 
+@pytest.fixture(autouse=True)
+def find_digest(mocker):
+    return mocker.patch('d.UpdateImage.find_digest', return_value=None)
+
+
+@pytest.fixture(autouse=True)
+def save_snapshot(mocker):
+    return mocker.patch('d.UpdateImage.save_snapshot')
+
+
 def call(command):
     command.handle(
         name='mystack',
@@ -36,3 +46,55 @@ def test_remainder(command, run, args_in_call):
     assert args_in_call(['docker', 'service', 'update'], args)
     assert args_in_call(['--image', 'org/img'], args)
     assert args_in_call(['--echo-test', 'mock', 'frontend'], args)
+
+
+def test_metrics(command, run):
+    call(command)
+
+    assert [m[1]['service'] for m in command.metrics.measurements] == ['backend', 'frontend']
+
+
+def test_metrics_are_exported_after_the_run(command, run, mocker):
+    write = mocker.patch('d.Metrics.write')
+    command.args.update(name='mystack', image='org/img', metrics_file='/tmp/d.prom')
+
+    command()
+
+    write.assert_called_once_with('/tmp/d.prom')
+    assert [m[0] for m in command.metrics.measurements] == ['service_update', 'service_update', 'run']
+
+
+def test_services_are_pinned_to_the_digest(command, run, find_digest, args_in_call):
+    find_digest.return_value = 'sha256:abcdef'
+
+    call(command)
+
+    for args in run.call_args_list:
+        assert args_in_call(['--image', 'org/img:latest@sha256:abcdef'], args[0][0])
+
+    find_digest.assert_called_once_with('org/img')  # resolved once for all services
+
+
+def test_no_pin(command, run, find_digest, args_in_call):
+    find_digest.return_value = 'sha256:abcdef'
+
+    command.handle(name='mystack', image='org/img:v1', remainder=[], no_pin=True)
+
+    assert args_in_call(['--image', 'org/img:v1'], run.call_args[0][0])
+    find_digest.assert_not_called()
+
+
+def test_image_is_required(command, run, save_snapshot):
+    with pytest.raises(SystemExit):
+        command.handle(name='mystack', image=None, remainder=[])
+
+    save_snapshot.assert_not_called()
+    run.assert_not_called()
+
+
+def test_snapshot_is_saved_before_the_update(command, run, save_snapshot):
+    save_snapshot.side_effect = lambda *args, **kwargs: run.assert_not_called()
+
+    call(command)
+
+    save_snapshot.assert_called_once_with('mystack', 'org/img', ['backend', 'frontend'], images=None)
@@ -0,0 +1,80 @@
+import subprocess
+
+import pytest
+from d import quote
+
+
+@pytest.fixture
+def local(mocker):
+    return mocker.patch('d.UpdateImage.local_registry_digest', side_effect=subprocess.CalledProcessError(1, 'docker'))
+
+
+@pytest.fixture
+def manager(mocker):
+    return mocker.patch('d.UpdateImage.manager_registry_digest', side_effect=subprocess.CalledProcessError(1, 'ssh'))
+
+
+def test_local(command, local, manager):
+    local.side_effect, local.return_value = None, 'sha256:local'
+
+    assert command.resolve_digest('org/img:v1') == 'org/img:v1@sha256:local'
+    manager.assert_not_called()
+
+
+def test_through_the_manager(command, local, manager):
+    manager.side_effect, manager.return_value = None, 'sha256:remote'
+
+    assert command.resolve_digest('org/img') == 'org/img:latest@sha256:remote'
+
+
+def test_unresolved(command, local, manager):
+    assert command.resolve_digest('org/img:v1') == 'org/img:v1'
+
+
+def test_already_pinned(command, local):
+    assert command.resolve_digest('org/img@sha256:abcdef') == 'org/img@sha256:abcdef'
+    local.assert_not_called()
+
+
+def test_cache(command, local, manager):
+    local.side_effect, local.return_value = None, 'sha256:local'
+
+    command.resolve_digest('org/img:v1')
+    command.resolve_digest('org/img:v1')
+
+    assert local.call_count == 1
+
+
+def test_local_call(command, run_output):
+    run_output.return_value = '{"mediaType": "application/vnd.oci.image.index.v1+json", "digest": "sha256:registry", "size": 100}'.encode()
+
+    assert command.local_registry_digest('org/img:v1') == 'sha256:registry'
+    run_output.assert_called_once_with(['docker', 'buildx', 'imagetools', 'inspect', '--format', '{{json .Manifest}}', 'org/img:v1'])
+
+
+def test_manager_call(command, run_output):
+    run_output.return_value = '{"digest": "sha256:registry"}'.encode()
+
+    assert command.manager_registry_digest('org/img:v1') == 'sha256:registry'
+    run_output.assert_called_once_with([
+        'ssh', '==MOCKED_HOST==', 'sh', '-c',
+        quote("docker buildx imagetools inspect --format '{{json .Manifest}}' org/img:v1"),
+    ])
+
+
+def test_manager_call_on_localhost(command, run_output):
+    command.host.name = 'localhost'
+    run_output.return_value = '{"digest": "sha256:registry"}'.encode()
+
+    assert command.manager_registry_digest('org/img:v1') == 'sha256:registry'
+    assert run_output.call_args[0][0][:2] == ['sh', '-c']
+
+
+def test_cached_images_are_never_used(command, run_output):
+    run_output.side_effect = subprocess.CalledProcessError(1, 'docker')  # the registry does not answer
+
+    assert command.find_digest('org/img:v1') is None
+    calls = ' '.join(' '.join(c[0][0]) for c in run_output.call_args_list)
+    assert run_output.call_count == 2
+    assert 'docker pull' not in calls
+    assert 'docker image inspect' not in calls
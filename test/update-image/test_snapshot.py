@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(monkeypatch, tmpdir):
+    monkeypatch.setenv('SNAPSHOT_DIR', str(tmpdir.join('snapshots')))
+    monkeypatch.setenv('STACK_DIR', '/srv')
+    monkeypatch.delenv('D_RUN_ID', raising=False)
+    monkeypatch.delenv('CIRCLE_WORKFLOW_ID', raising=False)
+    return tmpdir.join('snapshots')
+
+
+@pytest.fixture(autouse=True)
+def fetch_images(mocker):
+    return mocker.patch('d.UpdateImage.fetch_images', return_value={
+        'mystack_backend': 'org/img:v1@sha256:old',
+        'mystack_worker': 'org/img:v2@sha256:new',
+    })
+
+
+def test_local_snapshot(command, run, snapshot_dir):
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend', 'mystack_worker'])
+
+    snapshot = json.loads(snapshot_dir.join('mystack.json').read())
+
+    assert snapshot['stack'] == 'mystack'
+    assert snapshot['image'] == 'org/img:v2@sha256:new'
+    assert snapshot['services'] == {'mystack_backend': 'org/img:v1@sha256:old'}  # worker already runs the new image
+
+
+def test_snapshot_is_copied_to_the_manager(command, run, snapshot_dir):
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    run.assert_any_call(['ssh', '==MOCKED_HOST==', 'mkdir', '-p', '/srv/mystack'])
+    run.assert_called_with(['scp', str(snapshot_dir.join('mystack.json')), '==MOCKED_HOST==:/srv/mystack/image-snapshot.json'])
+
+
+def test_nothing_changes(command, run, fetch_images, snapshot_dir):
+    fetch_images.return_value = {'mystack_backend': 'org/img:v2@sha256:new'}
+
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    assert not snapshot_dir.join('mystack.json').exists()
+    run.assert_not_called()
+
+
+@pytest.fixture
+def existing(mocker):
+    return mocker.patch('d.UpdateImage.load_snapshot', return_value={
+        'stack': 'mystack',
+        'image': 'org/other:v2@sha256:new',
+        'run': 'workflow-1',
+        'services': {'mystack_frontend': 'org/other:v1@sha256:old'},
+    })
+
+
+def test_snapshots_of_a_single_run_are_merged(command, run, existing, snapshot_dir, monkeypatch):
+    monkeypatch.setenv('CIRCLE_WORKFLOW_ID', 'workflow-1')
+
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    snapshot = json.loads(snapshot_dir.join('mystack.json').read())
+    assert snapshot['run'] == 'workflow-1'
+    assert snapshot['services'] == {
+        'mystack_backend': 'org/img:v1@sha256:old',
+        'mystack_frontend': 'org/other:v1@sha256:old',
+    }
+
+
+def test_images_recorded_earlier_in_the_run_win(command, run, existing, snapshot_dir, monkeypatch):
+    monkeypatch.setenv('CIRCLE_WORKFLOW_ID', 'workflow-1')
+    existing.return_value['services'] = {'mystack_backend': 'org/img:v0@sha256:older'}
+
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    assert json.loads(snapshot_dir.join('mystack.json').read())['services'] == {'mystack_backend': 'org/img:v0@sha256:older'}
+
+
+def test_snapshot_of_another_run_is_replaced(command, run, existing, snapshot_dir, monkeypatch):
+    monkeypatch.setenv('CIRCLE_WORKFLOW_ID', 'workflow-2')
+
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    assert json.loads(snapshot_dir.join('mystack.json').read())['services'] == {'mystack_backend': 'org/img:v1@sha256:old'}
+
+
+def test_run_id_can_be_set_explicitly(command, run, existing, snapshot_dir, monkeypatch):
+    monkeypatch.setenv('CIRCLE_WORKFLOW_ID', 'workflow-2')
+    monkeypatch.setenv('D_RUN_ID', 'workflow-1')
+
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    assert 'mystack_frontend' in json.loads(snapshot_dir.join('mystack.json').read())['services']
+
+
+def test_without_run_id_the_snapshot_is_replaced(command, run, existing, snapshot_dir):
+    command.save_snapshot('mystack', 'org/img:v2@sha256:new', ['mystack_backend'])
+
+    existing.assert_not_called()